@@ -11,6 +11,7 @@ if DEBUG:
     loghandler.setLevel(logging.DEBUG)
     logger.setLevel(logging.DEBUG)
 else:
-    loghandler.setLevel(logging.CRITICAL)
-    logger.setLevel(logging.CRITICAL)
+    ## warnings still show, like failed background updates.
+    loghandler.setLevel(logging.WARNING)
+    logger.setLevel(logging.WARNING)
 
@@ -0,0 +1,129 @@
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+# history.py imports the plugin by the name calibre loads it under.  The
+# calibre_plugins.koreader and .device packages are set up here by path
+# only, their __init__s need calibre itself.
+KOREADER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for name, path in (
+    ("calibre_plugins", None),
+    ("calibre_plugins.koreader", KOREADER_DIR),
+    ("calibre_plugins.koreader.device", os.path.join(KOREADER_DIR, "device")),
+):
+    if name not in sys.modules:
+        package = types.ModuleType(name)
+        package.__path__ = [path] if path else []
+        sys.modules[name] = package
+from calibre_plugins.koreader import luadata
+from calibre_plugins.koreader.device.history import bump_history, prune_history
+
+# as KOReader writes it
+HISTORY = """return {
+    [1] = {
+        ["file"] = "/mnt/onboard/calibre/1.epub",
+        ["time"] = 1750000003,
+    },
+    [2] = {
+        ["file"] = "/mnt/onboard/calibre/say \\"hi\\".epub",
+        ["time"] = 1750000002,
+    },
+    [3] = {
+        ["file"] = "/mnt/onboard/calibre/3.epub",
+        ["time"] = 1750000001,
+    },
+}
+"""
+
+FILE_1 = "/mnt/onboard/calibre/1.epub"
+FILE_2 = '/mnt/onboard/calibre/say "hi".epub'
+FILE_3 = "/mnt/onboard/calibre/3.epub"
+
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "history.lua")
+        self.write(HISTORY)
+
+    def write(self, text):
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write(text)
+
+    def read(self):
+        return luadata.read(self.path, encoding="utf-8")
+
+
+class TestBumpHistoryMethods(HistoryTestCase):
+    def test_bump(self):
+        self.assertTrue(bump_history(self.path, [FILE_3, FILE_2]))
+        self.assertEqual(
+            self.read(),
+            [
+                {"file": FILE_3, "time": 1750000001},
+                {"file": FILE_2, "time": 1750000002},
+                {"file": FILE_1, "time": 1750000003},
+            ],
+        )
+
+    def test_new(self):
+        self.assertTrue(bump_history(self.path, ["/mnt/onboard/new.epub", FILE_2], now=1760000000))
+        self.assertEqual(
+            self.read(),
+            [
+                {"file": "/mnt/onboard/new.epub", "time": 1760000000},
+                {"file": FILE_2, "time": 1750000002},
+                {"file": FILE_1, "time": 1750000003},
+                {"file": FILE_3, "time": 1750000001},
+            ],
+        )
+
+    def test_already_first(self):
+        with open(self.path, "rb") as file:
+            before = file.read()
+        self.assertFalse(bump_history(self.path, [FILE_1, FILE_2]))
+        self.assertFalse(bump_history(self.path, [FILE_1, FILE_1]))
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(), before)
+
+    def test_empty(self):
+        self.write("return {}\n")
+        self.assertTrue(bump_history(self.path, [FILE_1], now=1760000000))
+        self.assertEqual(self.read(), [{"file": FILE_1, "time": 1760000000}])
+
+    def test_not_a_list(self):
+        self.write('return {\n    ["a"] = {\n        ["file"] = "/a",\n    },\n}\n')
+        with self.assertRaises(ValueError):
+            bump_history(self.path, [FILE_1])
+        self.write('return {\n    [2] = {\n        ["file"] = "/a",\n    },\n}\n')
+        with self.assertRaises(ValueError):
+            bump_history(self.path, [FILE_1])
+
+
+class TestPruneHistoryMethods(HistoryTestCase):
+    def test_prune(self):
+        self.assertEqual(prune_history(self.path, lambda filepath: filepath == FILE_2), 1)
+        self.assertEqual(
+            self.read(),
+            [{"file": FILE_1, "time": 1750000003}, {"file": FILE_3, "time": 1750000001}],
+        )
+
+    def test_nothing_missing(self):
+        with open(self.path, "rb") as file:
+            before = file.read()
+        self.assertEqual(prune_history(self.path, lambda filepath: False), 0)
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(), before)
+
+    def test_not_a_list(self):
+        self.write('return {\n    ["a"] = {\n        ["file"] = "/a",\n    },\n}\n')
+        with self.assertRaises(ValueError):
+            prune_history(self.path, lambda filepath: True)
+
+
+if __name__ == "__main__":
+    unittest.main()
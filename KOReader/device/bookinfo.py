@@ -0,0 +1,212 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""KOReader's bookinfo_cache.sqlite3, the cover browser's book cache."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import os
+import apsw
+
+import logging
+logger = logging.getLogger(__name__)
+
+## KOReader stores cover thumbnails zstd compressed.  Without the
+## module nothing is prefilled: a row without a cover is extracted
+## again by KOReader's cover views anyway.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+## bookinfo columns filled in by prefill, see KOReader's
+## plugins/coverbrowser.koplugin/bookinfomanager.lua
+PREFILL_COLUMNS = (
+    'directory', 'filename', 'filesize', 'filemtime', 'in_progress',
+    'unsupported', 'cover_fetched', 'has_meta', 'has_cover',
+    'cover_sizetag', 'ignore_meta', 'ignore_cover', 'pages',
+    'title', 'authors', 'series', 'series_index', 'language',
+    'keywords', 'description',
+    'cover_w', 'cover_h', 'cover_bb_type', 'cover_bb_stride', 'cover_bb_data',
+    )
+
+## KOReader blitbuffer type of 8 bit grayscale.
+BB8 = 2
+## Covers are kept at most this big, KOReader scales them down for
+## its mosaic and list views.
+MAX_COVER_W = 600
+MAX_COVER_H = 800
+
+## prune only VACUUMs without deleting rows itself once this much
+## of the file is free pages.
+VACUUM_FREE_FRACTION = 0.25
+
+def invalidate(cache_sql_path, paths):
+    '''
+    Remove the cached (directory, filename) books so KOReader
+    reextracts them.  All in one transaction: on the device's
+    flash every transaction is a journal sync.  Returns the number
+    of rows removed.
+    '''
+    if not paths:
+        return 0
+    db = apsw.Connection(cache_sql_path)
+    try:
+        before = db.totalchanges()
+        with db:
+            for path, filename in paths:
+                logger.debug("Remove '%s','%s' from cache db"%(path,filename))
+            db.executemany('delete from bookinfo where directory=? and filename=?',
+                           paths)
+        return db.totalchanges() - before
+    finally:
+        db.close()
+
+def book_cover(book_path):
+    '''Cover image data embedded in a book file, or None.'''
+    from calibre.ebooks.metadata.meta import get_metadata
+    ext = os.path.splitext(book_path)[1][1:].lower()
+    try:
+        with open(book_path, 'rb') as f:
+            mi = get_metadata(f, ext)
+    except Exception as e:
+        logger.debug("Can't get cover from '%s': %s"%(book_path, e))
+        return None
+    if mi.cover_data and mi.cover_data[1]:
+        return mi.cover_data[1]
+    return None
+
+def cover_thumbnail(data, max_w=MAX_COVER_W, max_h=MAX_COVER_H):
+    '''
+    Cover image data as KOReader keeps it: (width, height, stride,
+    zstd compressed 8 bit grayscale pixels), or None.
+    '''
+    if zstandard is None or not data:
+        return None
+    from calibre.utils.img import image_from_data
+    from qt.core import Qt, QImage
+    try:
+        img = image_from_data(data)
+    except Exception as e:
+        logger.debug("Can't load cover: %s"%e)
+        return None
+    if img.isNull():
+        return None
+    if img.width() > max_w or img.height() > max_h:
+        img = img.scaled(max_w, max_h, Qt.AspectRatioMode.KeepAspectRatio,
+                         Qt.TransformationMode.SmoothTransformation)
+    img = img.convertToFormat(QImage.Format.Format_Grayscale8)
+    w, h, bpl = img.width(), img.height(), img.bytesPerLine()
+    bits = img.constBits()
+    bits.setsize(img.sizeInBytes())
+    pixels = bytes(bits)
+    if bpl != w:
+        ## Qt pads lines to 32 bits, KOReader's are packed.
+        pixels = b''.join(pixels[y*bpl:y*bpl+w] for y in range(h))
+    return w, h, w, zstandard.ZstdCompressor().compress(pixels)
+
+def book_row(directory, filename, device_path, mi, cover=None):
+    '''
+    A complete bookinfo row for a book just written to device_path,
+    from its calibre metadata and cover thumbnail.
+    '''
+    from calibre.utils.localization import lang_as_iso639_1
+    stat = os.stat(device_path)
+    language = None
+    if mi.languages:
+        language = lang_as_iso639_1(mi.languages[0]) or mi.languages[0]
+    row = {
+        'directory': directory,
+        'filename': filename,
+        'filesize': stat.st_size,
+        'filemtime': int(stat.st_mtime),
+        'in_progress': 0,
+        'unsupported': None,
+        'cover_fetched': None,
+        'has_meta': 'Y',
+        'has_cover': None,
+        'cover_sizetag': None,
+        'ignore_meta': None,
+        'ignore_cover': None,
+        'pages': None,
+        'title': mi.title,
+        ## KOReader lists several authors or keywords one per line.
+        'authors': '\n'.join(mi.authors or []) or None,
+        'series': mi.series or None,
+        'series_index': mi.series_index if mi.series else None,
+        'language': language,
+        'keywords': '\n'.join(mi.tags or []) or None,
+        'description': mi.comments or None,
+        'cover_w': None,
+        'cover_h': None,
+        'cover_bb_type': None,
+        'cover_bb_stride': None,
+        'cover_bb_data': None,
+        }
+    if cover:
+        w, h, stride, data = cover
+        row.update({
+                'cover_fetched': 'Y',
+                'has_cover': 'Y',
+                'cover_sizetag': 'M',
+                'cover_w': w,
+                'cover_h': h,
+                'cover_bb_type': BB8,
+                'cover_bb_stride': stride,
+                'cover_bb_data': data,
+                })
+    return row
+
+def prefill(cache_sql_path, rows):
+    '''
+    Insert or replace bookinfo rows, in one transaction.  Returns
+    False, changing nothing, if the cache db isn't the schema
+    expected.
+    '''
+    if not rows:
+        return True
+    db = apsw.Connection(cache_sql_path)
+    try:
+        columns = set(row[1] for row in db.execute('pragma table_info(bookinfo)'))
+        missing = set(PREFILL_COLUMNS) - columns
+        if missing:
+            logger.debug("Unexpected bookinfo schema, missing %s"%sorted(missing))
+            return False
+        sql = 'insert or replace into bookinfo (%s) values (%s)'%(
+            ', '.join(PREFILL_COLUMNS), ', '.join('?'*len(PREFILL_COLUMNS)))
+        with db:
+            for row in rows:
+                logger.debug("Prefill '%s','%s' in cache db"%(row['directory'],row['filename']))
+            db.executemany(sql, [ tuple(row[col] for col in PREFILL_COLUMNS) for row in rows ])
+    finally:
+        db.close()
+    return True
+
+def prune(cache_sql_path, is_missing):
+    '''
+    Remove the rows of books for which is_missing(directory +
+    filename) is true, in one transaction, then VACUUM if that
+    deleted rows or free pages left by earlier deletes pass
+    VACUUM_FREE_FRACTION of the file.  Returns (rows removed, bytes
+    reclaimed).
+    '''
+    size = os.path.getsize(cache_sql_path)
+    db = apsw.Connection(cache_sql_path)
+    try:
+        paths = [ (directory, filename) for directory, filename
+                  in db.execute('select directory, filename from bookinfo')
+                  if is_missing((directory or '') + (filename or '')) ]
+        if paths:
+            with db:
+                for path, filename in paths:
+                    logger.debug("Prune '%s','%s' from cache db"%(path,filename))
+                db.executemany('delete from bookinfo where directory=? and filename=?',
+                               paths)
+        free = db.execute('pragma freelist_count').fetchall()[0][0]
+        pages = db.execute('pragma page_count').fetchall()[0][0]
+        if free and (paths or free > pages * VACUUM_FREE_FRACTION):
+            db.execute('vacuum')
+    finally:
+        db.close()
+    return len(paths), size - os.path.getsize(cache_sql_path)
@@ -7,16 +7,30 @@ __copyright__ = "2025, Jim Miller"
 __docformat__ = "markdown en"
 
 import os
+import json
 import apsw
+import threading
+from functools import partial
 from collections import OrderedDict
 from datetime import datetime
 
 import logging
 logger = logging.getLogger(__name__)
 
+from calibre.constants import cache_dir
 from calibre.devices.user_defined.driver import USER_DEFINED
 
 from calibre_plugins.koreader import luadata
+from calibre_plugins.koreader.device.history import bump_history, prune_history
+from calibre_plugins.koreader.device.sidecars import SidecarIndex
+from calibre_plugins.koreader.device.session import SessionQueue, Worker
+from calibre_plugins.koreader.device.timing import Timings
+from calibre_plugins.koreader.device.manifest import MANIFEST_NAME, Manifest, file_sha1
+from calibre_plugins.koreader.device.partialmd5 import (DigestCache, partial_md5, sidecar_path,
+                                                        set_sidecar_md5, set_stats_md5)
+from calibre_plugins.koreader.device import bookinfo, readingstate
+from calibre_plugins.koreader.luadata.io.write import atomic_open
+from calibre_plugins.koreader.stats import importer, uuids
 
 class KOREADER(USER_DEFINED):
     """
@@ -77,6 +91,52 @@ class KOREADER(USER_DEFINED):
             "KOReader's relative path ON DEVICE.  Needs to match keys in cache and history.") + '</p>',
         _('Bump Up History Tag') + ':::<p>' + _(
             "If set, ONLY books with this tag will be bumped up the History list.  Otherwise, all sent books will be.") + '</p>',
+        _('Reading Progress Column') + ':::<p>' + _(
+            "Lookup name of a custom column (like #progress) to get KOReader's percent read when the device connects.  "
+            "Integer and float columns get 0-100, text columns '42%'.  Leave blank to not sync it.") + '</p>',
+        _('Reading Status Column') + ':::<p>' + _(
+            "Lookup name of a custom column to get KOReader's book status (reading, complete, abandoned).  "
+            "Yes/no columns get yes for complete.  Leave blank to not sync it.") + '</p>',
+        _('Last Read Column') + ':::<p>' + _(
+            "Lookup name of a date custom column to get when the book was last opened in KOReader.  "
+            "Leave blank to not sync it.") + '</p>',
+        _('Highlights Column') + ':::<p>' + _(
+            "Lookup name of an integer custom column to get the book's number of KOReader highlights.  "
+            "Leave blank to not sync it.") + '</p>',
+        _('Prefill KOReader Cache') + ':::<p>' + _(
+            "Instead of only removing sent books from KOReader's cache, fill in their title, authors, series, etc "
+            "and cover thumbnail from Calibre, so KOReader doesn't have to open each book to show it.  "
+            "Needs the zstandard python module in Calibre, without it, or for books without a cover, "
+            "sent books are only removed from the cache.") + '</p>',
+        _('KOReader Update Delay') + ':::<p>' + _(
+            "Seconds after the last book is sent before KOReader's cache and history are updated, "
+            "so several sends in a row update them only once.  They are always updated on eject.  "
+            "0 waits for eject.") + '</p>',
+        _('Skip Unchanged Books') + ':::<p>' + _(
+            "Keep a record of the books sent in a small file on the device, and don't copy a book again, "
+            "or clear it from KOReader's cache, when it hasn't changed since it was last sent.") + '</p>',
+        _('Bump Unchanged Books') + ':::<p>' + _(
+            "Still bump books skipped as unchanged up the History list.") + '</p>',
+        _('KOReader Statistics File') + ':::<p>' + _(
+            "KOReader's statistics.sqlite3 file relative to Calibre's 'main' dir.  With the "
+            "2-statistics-with-uuid-key.lua patch's uuid table, sent books' md5 is updated there, "
+            "as it is in their existing sidecars, so KOReader doesn't compute it when opening them.") + '</p>',
+        _('Clean Up KOReader On Connect') + ':::<p>' + _(
+            "When the device connects, remove books no longer on it from KOReader's cache and History, "
+            "and compact the cache file.") + '</p>',
+        _('Map Statistics On Connect') + ':::<p>' + _(
+            "When the device connects, add the books on it to the uuid table of the KOReader Statistics File, "
+            "matched by partial md5 or title and authors, for the 2-statistics-with-uuid-key.lua patch.") + '</p>',
+        _('Reading Time Column') + ':::<p>' + _(
+            "Lookup name of a custom column to get the total time spent reading the book from KOReader's "
+            "statistics, through their uuid table.  Integer and float columns get minutes, text columns h:mm.  "
+            "Leave blank to not sync it.") + '</p>',
+        _('Pages Read Column') + ':::<p>' + _(
+            "Lookup name of an integer custom column to get the number of pages read from KOReader's statistics.  "
+            "Leave blank to not sync it.") + '</p>',
+        _('Reading Sessions Column') + ':::<p>' + _(
+            "Lookup name of an integer custom column to get the number of reading sessions from KOReader's "
+            "statistics.  Leave blank to not sync it.") + '</p>',
     ]
     EXTRA_CUSTOMIZATION_DEFAULT = [
                 '0xffff',
@@ -95,12 +155,53 @@ class KOREADER(USER_DEFINED):
                 '.adds/koreader/history.lua',
                 '/mnt/onboard',
                 '',
+                '',
+                '',
+                '',
+                '',
+                False,
+                '10',
+                False,
+                True,
+                '.adds/koreader/settings/statistics.sqlite3',
+                False,
+                False,
+                '',
+                '',
+                '',
     ]
 
     OPT_KOREADER_CACHE        = 12
     OPT_KOREADER_HISTORY      = 13
     OPT_KOREADER_ONBOARD      = 14
     OPT_KOREADER_BUMP_TAG     = 15
+    OPT_KOREADER_SYNC_PERCENT = 16
+    OPT_KOREADER_SYNC_STATUS  = 17
+    OPT_KOREADER_SYNC_READ    = 18
+    OPT_KOREADER_SYNC_HIGHLIGHTS = 19
+    OPT_KOREADER_PREFILL      = 20
+    OPT_KOREADER_DELAY        = 21
+    OPT_KOREADER_SKIP_UNCHANGED = 22
+    OPT_KOREADER_BUMP_UNCHANGED = 23
+    OPT_KOREADER_STATS        = 24
+    OPT_KOREADER_CLEANUP      = 25
+    OPT_KOREADER_MAP_STATS    = 26
+    OPT_KOREADER_SYNC_TIME    = 27
+    OPT_KOREADER_SYNC_PAGES   = 28
+    OPT_KOREADER_SYNC_SESSIONS = 29
+
+    ## parsed history.lua, kept across upload_books calls and
+    ## calibre sessions while the file doesn't change.
+    _history_cache = None
+    ## held by everything that uses KOReader's files on the device
+    ## or _history_cache, from the device thread or the worker.
+    ## Worker tasks hold it through whole flushes and VACUUMs, so
+    ## it's never taken on calibre's GUI thread: synchronize_with_db
+    ## only writes what books() read.
+    _koreader_lock = threading.RLock()
+    ## milliseconds to wait for a lock on statistics.sqlite3 before
+    ## apsw.BusyError.
+    STATS_BUSY_TIMEOUT = 5000
 
     def upload_books(self, files, names, on_card=None, end_session=True,
                      metadata=None):
@@ -108,9 +209,34 @@ class KOREADER(USER_DEFINED):
         # logger.debug(f'uploading {files} books')
         # logger.debug(f'uploading {names}')
         # logger.debug(f'uploading {metadata}')
-        retlist = super(KOREADER, self).upload_books(files, names, on_card, end_session, metadata)
-
+        self.report_worker_errors()
         e = self.settings().extra_customization
+        timings = self._timings = Timings('upload_books')
+
+        ## put_file skips books the manifest says are already there.
+        self._unchanged_paths = set()
+        self._manifest = None
+        if e[self.OPT_KOREADER_SKIP_UNCHANGED] and on_card is None:
+            try:
+                self._manifest = Manifest(os.path.join(self._main_prefix, MANIFEST_NAME)).open()
+            except Exception as ex:
+                logger.debug("Can't open the manifest, sending everything: %s"%ex)
+        try:
+            with timings.phase('copy'):
+                retlist = super(KOREADER, self).upload_books(files, names, on_card, end_session, metadata)
+                if self._manifest is not None:
+                    self._manifest.commit()
+        finally:
+            if self._manifest is not None:
+                self._manifest.close()
+                self._manifest = None
+            self._timings = None
+        unchanged = [ book[0] in self._unchanged_paths for book in retlist ]
+        if any(unchanged):
+            logger.debug("%d of %d books unchanged"%(unchanged.count(True), len(retlist)))
+        timings.count('books', len(retlist))
+        timings.count('unchanged', unchanged.count(True))
+        timings.count('bytes', sum( os.path.getsize(f) for f in files if isinstance(f, str) ))
         # logger.debug("KOReader:upload_books: cache:%s"%e[self.OPT_KOREADER_CACHE])
         # logger.debug("KOReader:upload_books: history:%s"%e[self.OPT_KOREADER_HISTORY])
 
@@ -130,68 +256,701 @@ class KOREADER(USER_DEFINED):
         # logger.debug("KOReader:upload_books: history_lua_path:%s"%history_lua_path)
         # logger.debug("KOReader:upload_books: history_lua_path isfile:%s"%os.path.isfile(history_lua_path))
 
-        db = None
-        if cache_sql_path:
-            db = apsw.Connection(cache_sql_path)
-            ## matching
-            ## 'D:\\calibre\\11956.epub'
-            ## to
-            ## '/mnt/onboard/calibre/', '7158.epub'
-            ##
-            updated_filepaths = []
-            for book in retlist:
-                path, filename = os.path.split(os.path.splitdrive(book[0])[1])
-                path = onboard_path + path.replace('\\','/')
-                if not path.endswith('/'):
-                    path = path + '/'
-                logger.debug("Remove '%s','%s' from cache db"%(path,filename))
-
-                # for row in db.execute('select directory, filename, title from bookinfo where directory=? and filename=?',
-                #                       (path, filename)):
-                #     logger.debug(row)
-                db.execute('delete from bookinfo where directory=? and filename=?',
-                           (path, filename))
-                updated_filepaths.append(path+filename)
-            db.close()
+        ## matching
+        ## 'D:\\calibre\\11956.epub'
+        ## to
+        ## '/mnt/onboard/calibre/', '7158.epub'
+        ##
+        updated_paths = []
+        for book in retlist:
+            path, filename = os.path.split(os.path.splitdrive(book[0])[1])
+            path = onboard_path + path.replace('\\','/')
+            if not path.endswith('/'):
+                path = path + '/'
+            updated_paths.append((path, filename))
+        updated_filepaths = [ path+filename for path, filename in updated_paths ]
 
+        bump_filepaths = []
         if history_lua_path:
-            data = luadata.read(history_lua_path, encoding="utf-8")
-            ## [
-            ##   {'file': '/mnt/onboard/.adds/koreader/help/quickstart-en-v2025.04.html',
-            ##    'time': 1750010070
-            ##   },
-            ##   {'file': ## '/mnt/onboard/calibre/8876.epub',
-            ##    'time': 1749698045
-            ##   },
-            ##   {'file': '/mnt/onboard/calibre/12805.epub',
-            ##    'time': 1750009108
-            ##   }, ... ]
-
-            # convert to an orderedict to key by file and preserve... order
-            odata = OrderedDict([ (x['file'], x) for x in data ])
-            # logger.debug(odata)
-
-            bump_list = []
-            if bump_tag:
-                bump_list = [ bump_tag in m.tags for m in reversed(metadata) ]
-            # logger.debug(bump_list)
             ## history only cares about order, so I don't bother updating
             ## the time, although it would be easy.
-            # logger.debug(updated_filepaths)
-            changed = False
-            for i, b in enumerate(reversed(updated_filepaths)):
-                # always if no bump_tag set.
-                if not bump_tag or bump_list[i]:
-                    if b not in odata:
-                        odata[b] = {'file':b,'time':int(datetime.now().timestamp()) }
-                    logger.debug('history bump:%s'%b)
-                    odata.move_to_end(b,last=False) # and the last shall be first...
-                    changed = True
-            if changed:
-                luadata.write(history_lua_path, list(odata.values()), encoding="utf-8",
-                              indent="\t", prefix="return ")
+            # always if no bump_tag set.
+            bump_unchanged = e[self.OPT_KOREADER_BUMP_UNCHANGED]
+            for b, m, same in zip(updated_filepaths, metadata, unchanged):
+                if same and not bump_unchanged:
+                    continue
+                if (not bump_tag or bump_tag in m.tags) and b not in bump_filepaths:
+                    bump_filepaths.append(b)
+            # logger.debug(bump_filepaths)
+
+        ## KOReader's cache of unchanged books is still good.
+        changed = [ i for i, same in enumerate(unchanged) if not same ]
+        updated_paths = [ updated_paths[i] for i in changed ]
+        changed_retlist = [ retlist[i] for i in changed ]
+        metadata = [ metadata[i] for i in changed ]
+
+        ## The rest happens in the background so calibre can finish
+        ## the send as soon as the books are copied.
+        prefill = bool(cache_sql_path and e[self.OPT_KOREADER_PREFILL])
+        stats_sql_path = e[self.OPT_KOREADER_STATS]
+        if stats_sql_path:
+            stats_sql_path = os.path.join(self._main_prefix, stats_sql_path)
+        self.worker().submit('queue updates for %d books'%len(retlist), self.queue_updates,
+                             cache_sql_path, updated_paths, changed_retlist, metadata, prefill,
+                             history_lua_path, bump_filepaths, stats_sql_path, end_session, timings)
+        if end_session:
+            ## the session is over, the caller may not be around
+            ## for a background flush.
+            self.worker().wait()
+            self.report_worker_errors()
         return retlist
 
+    def put_file(self, infile, path, replace_file=False, end_session=True):
+        manifest = getattr(self, '_manifest', None)
+        if manifest is None or hasattr(infile, 'read'):
+            return super(KOREADER, self).put_file(infile, path, replace_file, end_session)
+        path = self.normalize_path(path)
+        relpath = os.path.relpath(path, self._main_prefix).replace(os.sep, '/')
+        with self._timings.phase('hash'):
+            sha1 = file_sha1(infile)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if manifest.unchanged(relpath, sha1, stat):
+            logger.debug("Unchanged, not copied: %s"%relpath)
+            self._unchanged_paths.add(path)
+            return path
+        path = super(KOREADER, self).put_file(infile, path, replace_file, end_session)
+        manifest.record(relpath, sha1, os.stat(path))
+        return path
+
+    def queue_updates(self, cache_sql_path, updated_paths, retlist, metadata, prefill,
+                      history_lua_path, bump_filepaths, stats_sql_path, end_session, timings):
+        '''
+        Add one send's KOReader updates to the session queue, see
+        flush_session.  Runs in the worker.
+        '''
+        rows = [None] * len(updated_paths)
+        if prefill:
+            with timings.phase('prefill rows'):
+                rows = self.bookinfo_rows(updated_paths, retlist, metadata)
+        ## KOReader hashes a book when opening it unless its sidecar
+        ## already has the digest.  A handful of 1KB reads here.
+        md5s = []
+        with timings.phase('partial md5'):
+            ## kept for map_statistics too
+            digests = self.digest_cache()
+            for book, m in zip(retlist, metadata):
+                try:
+                    md5 = partial_md5(book[0])
+                    md5s.append((book[0], m.uuid, md5))
+                    digests.record(os.path.relpath(book[0], self._main_prefix).replace(os.sep, '/'),
+                                   os.stat(book[0]), md5)
+                except OSError as e:
+                    logger.debug("Can't digest '%s': %s"%(book[0], e))
+            digests.save()
+        timings.report(self.timings_path())
+        ## the device files are updated once for all the sends of a
+        ## session
+        queue = self.session_queue()
+        queue.add(cache_sql_path, list(zip(updated_paths, rows)),
+                  history_lua_path, bump_filepaths, stats_sql_path, md5s)
+        if end_session:
+            queue.flush()
+
+    def bookinfo_rows(self, updated_paths, retlist, metadata):
+        '''
+        Complete KOReader cache rows for the sent books, made from
+        calibre's metadata and the cover in the copy on the device.
+        None for the books that can only be removed from the cache:
+        KOReader's cover views extract a book again when its row has
+        no cover, so a row without one gains nothing.
+        '''
+        if bookinfo.zstandard is None:
+            logger.debug("No zstandard module, KOReader's cache is only cleared")
+            return [None] * len(updated_paths)
+        rows = []
+        for i, ((path, filename), book, m) in enumerate(zip(updated_paths, retlist, metadata)):
+            logger.debug("Prefill row %d/%d: %s"%(i+1, len(retlist), filename))
+            try:
+                cover = bookinfo.cover_thumbnail(bookinfo.book_cover(book[0]))
+                if cover is None:
+                    logger.debug("No cover to prefill '%s'"%filename)
+                    rows.append(None)
+                    continue
+                rows.append(bookinfo.book_row(path, filename, book[0], m, cover))
+            except Exception as e:
+                logger.debug("Can't prefill '%s': %s"%(filename, e))
+                rows.append(None)
+        return rows
+
+    def session_queue(self):
+        try:
+            delay = float(self.settings().extra_customization[self.OPT_KOREADER_DELAY] or 0)
+        except ValueError:
+            delay = 0
+        if getattr(self, '_session_queue', None) is None:
+            self._session_queue = SessionQueue(partial(self.locked, self.flush_koreader))
+        self._session_queue.idle_timeout = delay
+        return self._session_queue
+
+    def worker(self):
+        if getattr(self, '_worker', None) is None:
+            self._worker = Worker('KOReader updates')
+        return self._worker
+
+    def locked(self, func, *args):
+        '''
+        func(*args) holding _koreader_lock.  Only from the device
+        thread or the worker, never calibre's GUI thread.
+        '''
+        with KOREADER._koreader_lock:
+            return func(*args)
+
+    def report_worker_errors(self):
+        '''
+        Warn about the worker tasks that failed since the last
+        device call, they can't raise in the job that queued them.
+        '''
+        if getattr(self, '_worker', None) is None:
+            return
+        for description, e in self._worker.take_errors():
+            logger.warning("KOReader update '%s' failed: %s"%(description, e))
+
+    def flush_session(self):
+        '''Apply the KOReader updates queued by upload_books now.'''
+        if getattr(self, '_session_queue', None) is not None:
+            self._session_queue.flush()
+
+    def flush_koreader(self, pending):
+        '''Update KOReader's cache, history and digests for all pending sends.'''
+        timings = Timings('flush')
+        if pending.cache_sql_path:
+            invalidate_paths = pending.invalidate_paths()
+            rows = pending.prefill_rows()
+            with timings.phase('cache'):
+                if rows:
+                    if bookinfo.prefill(pending.cache_sql_path, rows):
+                        timings.count('rows prefilled', len(rows))
+                    else:
+                        invalidate_paths.extend( (row['directory'], row['filename']) for row in rows )
+                timings.count('rows deleted', bookinfo.invalidate(pending.cache_sql_path, invalidate_paths))
+
+        if pending.history_lua_path and pending.bump_filepaths:
+            try:
+                with timings.phase('history splice'):
+                    moved = bump_history(pending.history_lua_path, pending.bump_filepaths, encoding="utf-8",
+                                         indent="\t", cache=self.history_cache())
+            except ValueError as e:
+                logger.debug("history.lua can't be spliced (%s), rewriting it"%e)
+                moved = True
+                self.rewrite_history(pending.history_lua_path, pending.bump_filepaths, timings)
+            timings.count('history moved', len(pending.bump_filepaths) if moved else 0)
+
+        with timings.phase('digests'):
+            for path, (uuid, md5) in pending.md5s.items():
+                if set_sidecar_md5(sidecar_path(path), md5):
+                    timings.count('sidecars')
+            if pending.stats_sql_path and pending.md5s and os.path.isfile(pending.stats_sql_path):
+                timings.count('statistics rows', set_stats_md5(
+                        pending.stats_sql_path,
+                        [ (uuid, md5) for uuid, md5 in pending.md5s.values() if uuid ]))
+        timings.report(self.timings_path())
+
+    def eject(self):
+        ## everything queued, then the flush, has to be done before
+        ## the device goes away.  Failures are logged by the worker.
+        worker = self.worker()
+        worker.submit('update on eject', self.flush_session)
+        worker.wait()
+        self.report_worker_errors()
+        super(KOREADER, self).eject()
+
+    def is_usb_connected(self, devices_on_system, debug=False, only_presence=False):
+        result = super(KOREADER, self).is_usb_connected(devices_on_system, debug, only_presence)
+        ## calibre polls this from its device thread, between device
+        ## jobs, so the idle flush takes its turn with them.
+        connected = result[0] if isinstance(result, tuple) else result
+        if connected and getattr(self, '_session_queue', None) is not None:
+            try:
+                self._session_queue.idle_flush()
+            except Exception as e:
+                logger.warning("KOReader update after idle failed: %s"%e)
+        return result
+
+    def shutdown(self):
+        ## calibre is closing, updates still waiting for the idle
+        ## flush would be lost with it.
+        ## Sends only queue updates through the worker, without one
+        ## nothing is pending.
+        if getattr(self, '_worker', None) is not None:
+            self._worker.submit('update on shutdown', self.flush_session)
+            self._worker.wait()
+            self.report_worker_errors()
+        super(KOREADER, self).shutdown()
+
+    def post_yank_cleanup(self):
+        if getattr(self, '_worker', None) is not None:
+            self._worker.cancel()
+        if getattr(self, '_session_queue', None) is not None:
+            self._session_queue.discard()
+        super(KOREADER, self).post_yank_cleanup()
+
+    def books(self, oncard=None, end_session=True):
+        self.report_worker_errors()
+        bl = super(KOREADER, self).books(oncard, end_session)
+        if oncard is None:
+            self._main_booklist = bl
+            e = self.settings().extra_customization
+            ## the device is read here, on the device thread.
+            ## synchronize_with_db runs on calibre's GUI thread and
+            ## only writes what was read to the library.
+            map_stats = e[self.OPT_KOREADER_MAP_STATS] and e[self.OPT_KOREADER_STATS]
+            sidecars = None
+            if self.reading_state_columns() or map_stats:
+                try:
+                    sidecars = self.locked(self.scan_sidecars)
+                except Exception as err:
+                    logger.exception("KOReader sidecar scan failed: %s"%err)
+            try:
+                self._reading_state_sync = self.read_reading_state(bl, sidecars)
+            except Exception as err:
+                logger.exception("KOReader reading state read failed: %s"%err)
+                self._reading_state_sync = None
+            if map_stats:
+                ## not on the worker, read_statistics needs the books
+                ## mapped before it aggregates them.
+                try:
+                    self.locked(self.map_statistics,
+                                [ (book.uuid, book.title, book.authors, book.lpath) for book in bl ],
+                                sidecars)
+                except Exception as err:
+                    logger.exception("KOReader statistics mapping failed: %s"%err)
+            try:
+                self._statistics_sync = self.locked(self.read_statistics)
+            except Exception as err:
+                logger.exception("KOReader statistics read failed: %s"%err)
+                self._statistics_sync = None
+            ## queued last, the reads above don't wait on its VACUUM.
+            if e[self.OPT_KOREADER_CLEANUP]:
+                self.worker().submit('clean up', self.locked, self.cleanup_koreader,
+                                     [ book.lpath for book in bl ])
+        return bl
+
+    def map_statistics(self, books, sidecars=None):
+        '''
+        Add the books on the device to the statistics uuid table,
+        see stats.uuids.populate.  books are (uuid, title, authors,
+        lpath) from calibre's device book list.  Nothing is done
+        when every statistics book is mapped already, and books are
+        only hashed when their sidecar, in the SidecarIndex sidecars,
+        and their title don't match.
+        '''
+        stats_sql_path = os.path.join(self._main_prefix,
+                                      self.settings().extra_customization[self.OPT_KOREADER_STATS])
+        if not os.path.isfile(stats_sql_path):
+            return 0
+        db = apsw.Connection(stats_sql_path)
+        db.setbusytimeout(self.STATS_BUSY_TIMEOUT)
+        try:
+            rows = uuids.unmapped_books(db)
+            if not rows:
+                return 0
+            mapped = uuids.mapped_uuids(db)
+            books = [ book for book in books if book[0] and book[0] not in mapped ]
+
+            ## KOReader puts its digest in the sidecar when it opens a book.
+            md5s = {}
+            for lpath, relpath, data in sidecars.books() if sidecars is not None else ():
+                md5 = data.get('partial_md5_checksum') if isinstance(data, dict) else None
+                if md5:
+                    md5s[lpath] = md5
+            matcher = uuids.Matcher()
+            for uuid, title, authors, lpath in books:
+                matcher.add(uuid, title, authors, md5s.get(lpath))
+            if any( matcher.match(title, authors, md5) is None for title, authors, md5 in rows ):
+                ## the rest only match by the file's digest, known
+                ## from when it was sent or hashed before.
+                digests = self.digest_cache()
+                for uuid, title, authors, lpath in books:
+                    if lpath not in md5s:
+                        try:
+                            matcher.add(uuid, title, authors, digests.digest(self._main_prefix, lpath))
+                        except OSError:
+                            pass
+                digests.save()
+            return uuids.populate(db, matcher)
+        finally:
+            db.close()
+
+    def digest_cache(self):
+        return DigestCache(self.device_cache_path('digests.json'))
+
+    def cleanup_koreader(self, lpaths):
+        '''
+        Remove the books that aren't on the device anymore from
+        KOReader's cache and history.lua in one pass, and compact the
+        cache.  lpaths are calibre's device book list, a file not in
+        it is only taken as missing once it's checked for.  Files
+        outside KOReader's onboard path are left alone.  Returns
+        (cache rows, history entries, cache bytes reclaimed).
+        '''
+        e = self.settings().extra_customization
+        prefix = e[self.OPT_KOREADER_ONBOARD].rstrip('/') + '/'
+        on_device = set( prefix + lpath for lpath in lpaths )
+        def is_missing(filepath):
+            if not filepath.startswith(prefix) or filepath in on_device:
+                return False
+            return not os.path.exists(os.path.join(self._main_prefix, filepath[len(prefix):]))
+
+        rows = reclaimed = 0
+        cache_sql_path = e[self.OPT_KOREADER_CACHE]
+        if cache_sql_path:
+            cache_sql_path = os.path.join(self._main_prefix, cache_sql_path)
+            if os.path.isfile(cache_sql_path):
+                rows, reclaimed = bookinfo.prune(cache_sql_path, is_missing)
+
+        entries = 0
+        history_lua_path = e[self.OPT_KOREADER_HISTORY]
+        if history_lua_path:
+            history_lua_path = os.path.join(self._main_prefix, history_lua_path)
+            if os.path.isfile(history_lua_path):
+                try:
+                    entries = prune_history(history_lua_path, is_missing, encoding="utf-8",
+                                            indent="\t", cache=self.history_cache())
+                except ValueError as ex:
+                    logger.debug("history.lua can't be spliced (%s), rewriting it"%ex)
+                    data = luadata.read(history_lua_path, encoding="utf-8",
+                                        cache=self.history_cache())
+                    kept = [ x for x in data if not is_missing(x.get('file') or '') ]
+                    entries = len(data) - len(kept)
+                    if entries:
+                        luadata.write(history_lua_path, kept, encoding="utf-8",
+                                      indent="\t", prefix="return ",
+                                      cache=self.history_cache())
+
+        ## logged as a warning to get past the WARNING level set
+        ## outside calibre's debug mode, and only when something was
+        ## done, so every connect isn't reported.
+        if rows or entries or reclaimed:
+            logger.warning("KOReader clean up: %d cache rows and %d history entries removed, %d KB reclaimed"%(
+                    rows, entries, reclaimed // 1024))
+        return rows, entries, reclaimed
+
+    def synchronize_with_db(self, db, book_id, book_metadata, first_call):
+        result = super(KOREADER, self).synchronize_with_db(db, book_id, book_metadata, first_call)
+        if not first_call:
+            return result
+        ## Everything is synced on the first call, in one batch per
+        ## column, the calls for the other books have nothing left.
+        self.report_worker_errors()
+        reading_state, self._reading_state_sync = getattr(self, '_reading_state_sync', None), None
+        try:
+            changed = self.sync_reading_state(db, reading_state)
+        except Exception as e:
+            logger.exception("KOReader reading state sync failed: %s"%e)
+            changed = None
+        statistics, self._statistics_sync = getattr(self, '_statistics_sync', None), None
+        try:
+            changed = (changed or set()) | (self.sync_statistics(db, statistics) or set())
+        except Exception as e:
+            logger.exception("KOReader statistics sync failed: %s"%e)
+        if changed:
+            return (changed | (result[0] or set()), result[1])
+        return result
+
+    def reading_state_columns(self, api=None):
+        return self.custom_columns(((readingstate.PERCENT, self.OPT_KOREADER_SYNC_PERCENT),
+                                    (readingstate.STATUS, self.OPT_KOREADER_SYNC_STATUS),
+                                    (readingstate.LAST_READ, self.OPT_KOREADER_SYNC_READ),
+                                    (readingstate.HIGHLIGHTS, self.OPT_KOREADER_SYNC_HIGHLIGHTS)), api)
+
+    def read_reading_state(self, booklist, sidecars):
+        '''
+        Reading state of the books in calibre's device booklist whose
+        sidecar, in the SidecarIndex sidecars, changed since the book
+        was last synced, for sync_reading_state.  Returns None when no
+        column is set or the sidecars couldn't be scanned,
+        else {'columns': {kind: column}, 'synced': {sidecar relpath:
+        stamp}, 'books': [(uuid, sidecar relpath, stamp, state)]}.
+        '''
+        e = self.settings().extra_customization
+        columns = self.reading_state_columns()
+        if not columns or sidecars is None:
+            return None
+
+        ## sync.json has the (size, mtime_ns) of each sidecar as it
+        ## was when its book was last written, for the same columns.
+        ## Changing them syncs everything again.
+        try:
+            with open(self.device_cache_path('sync.json')) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        synced = state.get('synced', {}) if state.get('columns') == columns else {}
+
+        index = sidecars
+        ## forget removed sidecars
+        synced = { relpath:stamp for relpath, stamp in synced.items() if relpath in index.entries }
+        changed_books = []
+        for lpath, relpath, data in index.books():
+            stamp = list(index.entries[relpath][:2])
+            if synced.get(relpath) != stamp:
+                changed_books.append((lpath, relpath, stamp, data))
+        logger.debug("%d sidecars changed since last sync"%len(changed_books))
+
+        books = []
+        if changed_books:
+            lpath_to_uuid = { b.lpath:b.uuid for b in booklist }
+            last_read = self.locked(self.history_times)
+            onboard_path = e[self.OPT_KOREADER_ONBOARD].rstrip('/') + '/'
+            for lpath, relpath, stamp, data in changed_books:
+                uuid = lpath_to_uuid.get(lpath)
+                if uuid:
+                    books.append((uuid, relpath, stamp,
+                                  readingstate.reading_state(data, last_read.get(onboard_path + lpath))))
+        return {'columns':columns, 'synced':synced, 'books':books}
+
+    def sync_reading_state(self, db, pending):
+        '''
+        Copy reading progress, status, last read time and highlight
+        count read by read_reading_state into the configured custom
+        columns.  Returns the ids of the books changed.
+        '''
+        api = db.new_api
+        fm = api.field_metadata
+        columns = self.reading_state_columns(api)
+        if not pending or not columns:
+            return None
+
+        uuid_to_id = { uuid:book_id for book_id, uuid in api.all_field_for('uuid', api.all_book_ids()).items() }
+        values = dict( (kind, {}) for kind in columns )
+        synced = pending['synced']
+        written = {}
+        for uuid, relpath, stamp, book_state in pending['books']:
+            book_id = uuid_to_id.get(uuid)
+            if book_id is None:
+                ## not matched (yet), looked at again next sync.
+                continue
+            written[relpath] = stamp
+            for kind, col in columns.items():
+                value = readingstate.column_value(fm[col]['datatype'], kind, book_state[kind])
+                if value is not None:
+                    values[kind][book_id] = value
+
+        changed = set()
+        for kind, col in columns.items():
+            if values[kind]:
+                logger.debug("Sync %s of %d books to %s"%(kind, len(values[kind]), col))
+                changed |= api.set_field(col, values[kind])
+
+        ## only once written, so a failed sync is retried.  Columns
+        ## missing from the library leave the state unmatched, and
+        ## everything is synced again once they're added.
+        synced.update(written)
+        state = {'synced':synced, 'columns':columns}
+        state_path = self.device_cache_path('sync.json')
+        try:
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+            with atomic_open(state_path, 'w') as f:
+                json.dump(state, f)
+        except OSError as err:
+            logger.debug("Can't save sync state: %s"%err)
+        return changed
+
+    def custom_columns(self, options, api=None):
+        '''
+        {kind: column} of the (kind, option) whose option names a
+        column.  With the library's api, only its custom columns.
+        '''
+        e = self.settings().extra_customization
+        columns = {}
+        for kind, opt in options:
+            col = (e[opt] or '').strip()
+            if not col:
+                continue
+            if api is not None and col not in api.field_metadata.custom_field_keys():
+                logger.debug("No custom column '%s' for %s"%(col, kind))
+                continue
+            columns[kind] = col
+        return columns
+
+    def statistics_columns(self, api=None):
+        return self.custom_columns(((readingstate.READ_TIME, self.OPT_KOREADER_SYNC_TIME),
+                                    (readingstate.PAGES_READ, self.OPT_KOREADER_SYNC_PAGES),
+                                    (readingstate.SESSIONS, self.OPT_KOREADER_SYNC_SESSIONS)), api)
+
+    def read_statistics(self):
+        '''
+        Total reading time, pages read and sessions from KOReader's
+        statistics, for sync_statistics.  Only books with page stats
+        newer than the last sync's, or whose uuid or book row changed
+        since, are aggregated, each over all its page stats.  Returns
+        None when there's nothing to sync, else {'columns', 'since',
+        'books', 'totals': {uuid: (seconds, pages, sessions)}}.
+        '''
+        e = self.settings().extra_customization
+        columns = self.statistics_columns()
+        if not columns or not e[self.OPT_KOREADER_STATS]:
+            return None
+        stats_sql_path = os.path.join(self._main_prefix, e[self.OPT_KOREADER_STATS])
+        if not os.path.isfile(stats_sql_path):
+            return None
+
+        ## statistics.json has the newest page stat start_time synced
+        ## and the uuid table and book totals as of the last sync.
+        try:
+            with open(self.device_cache_path('statistics.json')) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        ## new columns get every book, not just the ones read since.
+        since = state.get('since', 0) if state.get('columns') == columns else 0
+        old_books = state.get('books', {}) if state.get('columns') == columns else {}
+
+        stats_db = apsw.Connection(stats_sql_path, flags=apsw.SQLITE_OPEN_READONLY)
+        stats_db.setbusytimeout(self.STATS_BUSY_TIMEOUT)
+        try:
+            with stats_db:
+                books = importer.book_states(stats_db)
+                uuids_changed, since = importer.read_since(stats_db, since)
+                uuids_changed.update( uuid for uuid, book in books.items() if old_books.get(uuid) != book )
+                totals = importer.aggregate(stats_db, uuids_changed)
+        finally:
+            stats_db.close()
+        logger.debug("Statistics of %d books changed"%len(totals))
+        return {'columns':columns, 'since':since, 'books':books, 'totals':totals}
+
+    def sync_statistics(self, db, pending):
+        '''
+        Copy the statistics totals read by read_statistics into the
+        configured custom columns.  Returns the ids of the books
+        changed.
+        '''
+        api = db.new_api
+        columns = self.statistics_columns(api)
+        if not pending or not columns:
+            return None
+
+        changed = set()
+        totals = pending['totals']
+        if totals:
+            uuid_to_id = { uuid:book_id for book_id, uuid in api.all_field_for('uuid', api.all_book_ids()).items() }
+            for kind, col, index in ((readingstate.READ_TIME, columns.get(readingstate.READ_TIME), importer.SECONDS),
+                                     (readingstate.PAGES_READ, columns.get(readingstate.PAGES_READ), importer.PAGES),
+                                     (readingstate.SESSIONS, columns.get(readingstate.SESSIONS), importer.SESSIONS)):
+                if not col:
+                    continue
+                datatype = api.field_metadata[col]['datatype']
+                values = {}
+                for uuid, total in totals.items():
+                    book_id = uuid_to_id.get(uuid)
+                    value = readingstate.column_value(datatype, kind, total[index])
+                    if book_id is not None and value is not None:
+                        values[book_id] = value
+                if values:
+                    logger.debug("Sync %s of %d books to %s"%(kind, len(values), col))
+                    changed |= api.set_field(col, values)
+
+        state = {'since':pending['since'], 'columns':columns, 'books':pending['books']}
+        state_path = self.device_cache_path('statistics.json')
+        try:
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+            with atomic_open(state_path, 'w') as f:
+                json.dump(state, f)
+        except OSError as err:
+            logger.debug("Can't save statistics sync state: %s"%err)
+        return changed
+
+    def history_times(self):
+        '''
+        Last opened time of each book in KOReader's history.lua, by
+        path on device.
+        '''
+        history_lua_path = self.settings().extra_customization[self.OPT_KOREADER_HISTORY]
+        if not history_lua_path:
+            return {}
+        history_lua_path = os.path.join(self._main_prefix, history_lua_path)
+        if not os.path.isfile(history_lua_path):
+            return {}
+        try:
+            history = luadata.read(history_lua_path, encoding="utf-8", cache=self.history_cache())
+        except Exception as e:
+            logger.debug("Can't read history.lua: %s"%e)
+            return {}
+        times = {}
+        for entry in history:
+            if isinstance(entry, dict) and 'file' in entry and 'time' in entry:
+                times.setdefault(entry['file'], entry['time'])
+        return times
+
+    def history_cache(self):
+        if KOREADER._history_cache is None:
+            KOREADER._history_cache = luadata.ReadCache(
+                maxsize=2, cache_dir=os.path.join(cache_dir(), 'koreader-history'))
+        return KOREADER._history_cache
+
+    def timings_path(self):
+        '''Where the timings of every device and session are kept.'''
+        return os.path.join(cache_dir(), 'koreader', 'timings.jsonl')
+
+    def device_cache_path(self, name):
+        '''
+        Local file for things kept about the connected device between
+        connects, by its calibre store uuid.
+        '''
+        driveinfo = getattr(self, 'driveinfo', None) or {}
+        uuid = driveinfo.get('main', {}).get('device_store_uuid', 'unknown')
+        return os.path.join(cache_dir(), 'koreader', uuid, name)
+
+    def scan_sidecars(self):
+        '''
+        Index the KOReader .sdr sidecars of every book on the device.
+        Only sidecars changed since the last connect are parsed.
+        '''
+        index = SidecarIndex(self.device_cache_path('sidecars.marshal'))
+        ## Parsed in this process: forking calibre's threaded GUI can
+        ## deadlock the children, and the saved index keeps rescans
+        ## down to the sidecars that changed.
+        index.scan(self._main_prefix, max_workers=1)
+        return index
+
+    def rewrite_history(self, history_lua_path, bump_filepaths, timings=None):
+        '''
+        Parse all of history.lua and write it back with bump_filepaths
+        first.  Only used when bump_history can't splice the file.
+        '''
+        if timings is None:
+            timings = Timings('rewrite_history')
+        with timings.phase('history read'):
+            data = luadata.read(history_lua_path, encoding="utf-8",
+                                cache=self.history_cache())
+        ## [
+        ##   {'file': '/mnt/onboard/.adds/koreader/help/quickstart-en-v2025.04.html',
+        ##    'time': 1750010070
+        ##   },
+        ##   {'file': ## '/mnt/onboard/calibre/8876.epub',
+        ##    'time': 1749698045
+        ##   },
+        ##   {'file': '/mnt/onboard/calibre/12805.epub',
+        ##    'time': 1750009108
+        ##   }, ... ]
+
+        # convert to an orderedict to key by file and preserve... order
+        odata = OrderedDict([ (x['file'], x) for x in data ])
+        # logger.debug(odata)
+
+        for b in reversed(bump_filepaths):
+            if b not in odata:
+                odata[b] = {'file':b,'time':int(datetime.now().timestamp()) }
+            logger.debug('history bump:%s'%b)
+            odata.move_to_end(b,last=False) # and the last shall be first...
+        with timings.phase('history write'):
+            luadata.write(history_lua_path, list(odata.values()), encoding="utf-8",
+                          indent="\t", prefix="return ",
+                          cache=self.history_cache())
+
     ## Also remove from cache on delete?  Deleting in KOReader
     ## doesn't bother, and there is a prune function in koreader.
     ## So, no.
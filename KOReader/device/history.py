@@ -0,0 +1,140 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""Incremental updates of KOReader's history.lua."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import re
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+from calibre_plugins.koreader import luadata
+from calibre_plugins.koreader.luadata.io.iterparse import iterspans
+from calibre_plugins.koreader.luadata.io.write import atomic_open
+
+## KOReader writes entries as { ["file"] = "...", ["time"] = ... }
+## with the keys sorted, so file is normally first.
+_FILE_RE = re.compile(
+    rb'\{\s*(?:\[\s*"file"\s*\]|file)\s*=\s*("[^"\\]*(?:\\.[^"\\]*)*")', re.S)
+_INDEX_RE = re.compile(rb'\[\s*([0-9]+)\s*\]\s*=')
+
+def entry_file(value, encoding="utf-8"):
+    '''
+    The 'file' of one history entry, given as the bytes of its table.
+    Only the file string is unserialized when it comes first.
+    '''
+    match = _FILE_RE.match(value)
+    if match:
+        quoted = match.group(1)
+        if b"\\" not in quoted:
+            return quoted[1:-1].decode(encoding)
+        return luadata.unserialize(quoted, encoding=encoding)
+    entry = luadata.unserialize(value, encoding=encoding)
+    return entry.get('file') if isinstance(entry, dict) else None
+
+def entries(history_lua_path, encoding="utf-8"):
+    '''
+    Yield (file, offset, bytes) of each history.lua entry's table,
+    in order.  Raises ValueError if history.lua isn't a plain list.
+    '''
+    with open(history_lua_path, "rb") as file:
+        for index, (start, value_start, end, data) in enumerate(iterspans(file)):
+            if value_start != start:
+                match = _INDEX_RE.fullmatch(data[:value_start - start].strip())
+                if not match or int(match.group(1)) != index + 1:
+                    raise ValueError("history.lua entry %d has an unexpected key"%(index + 1))
+            value = data[value_start - start:]
+            value_start = value_start + len(value) - len(value.lstrip())
+            value = value.strip()
+            yield entry_file(value, encoding), value_start, value
+
+def write_spans(history_lua_path, values, spans, indent="\t", encoding="utf-8"):
+    '''
+    Replace history.lua with a list of the new entry values (bytes)
+    followed by its own entries at spans, copied byte for byte.
+    '''
+    head = b"\n" + indent.encode(encoding)
+    with atomic_open(history_lua_path, "wb") as out:
+        out.write(b"return {")
+        for value in values:
+            out.write(head + value + b",")
+        with open(history_lua_path, "rb") as file:
+            for start, end in spans:
+                file.seek(start)
+                out.write(head + file.read(end - start) + b",")
+        out.write(b"\n}\n")
+
+def bump_history(history_lua_path, filepaths, encoding="utf-8",
+                 indent="\t", now=None, cache=None):
+    '''
+    Move filepaths to the front of history.lua, in order, adding
+    the ones not in it yet.
+
+    The file is scanned once for the byte spans of its entries.
+    Only new entries are serialized, every other entry is copied
+    over byte for byte.  The `[n] =` keys are dropped, which lua
+    reads the same.
+
+    Returns False if filepaths were already first and nothing was
+    written.  Raises ValueError if history.lua isn't a plain list,
+    callers can fall back to rewriting it whole.
+    '''
+    bumps = {}
+    for filepath in filepaths:
+        bumps.setdefault(filepath, None)
+    order = list(bumps)
+    if not order:
+        return False
+
+    spans = [] # (start, end) of the entries kept in place
+    in_order = 0
+    for index, (filepath, value_start, value) in enumerate(entries(history_lua_path, encoding)):
+        if filepath in bumps:
+            if in_order == index and order[index] == filepath:
+                in_order = in_order + 1
+                if in_order == len(order):
+                    return False
+            bumps[filepath] = value
+        else:
+            spans.append((value_start, value_start + len(value)))
+
+    if now is None:
+        now = int(time.time())
+    values = []
+    for filepath in order:
+        value = bumps[filepath]
+        if value is None:
+            value = luadata.serialize({'file':filepath, 'time':now}, encoding=encoding,
+                                      indent=indent, indent_level=1).encode(encoding)
+        logger.debug('history bump:%s'%filepath)
+        values.append(value)
+    write_spans(history_lua_path, values, spans, indent, encoding)
+    if cache is not None:
+        cache.invalidate(history_lua_path)
+    return True
+
+def prune_history(history_lua_path, is_missing, encoding="utf-8",
+                  indent="\t", cache=None):
+    '''
+    Remove the entries for which is_missing(file) is true, copying
+    the others over byte for byte.  Returns the number removed,
+    nothing is written if that's 0.  Raises ValueError like
+    bump_history.
+    '''
+    spans = []
+    removed = 0
+    for filepath, value_start, value in entries(history_lua_path, encoding):
+        if filepath is not None and is_missing(filepath):
+            logger.debug('history prune:%s'%filepath)
+            removed = removed + 1
+        else:
+            spans.append((value_start, value_start + len(value)))
+    if removed:
+        write_spans(history_lua_path, [], spans, indent, encoding)
+        if cache is not None:
+            cache.invalidate(history_lua_path)
+    return removed
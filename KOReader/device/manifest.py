@@ -0,0 +1,78 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""On device record of the book files calibre sent, to skip resending unchanged ones."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import hashlib
+import apsw
+
+import logging
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.koreader-manifest.sqlite3'
+
+## bump with a migration in Manifest.open when the table changes.
+SCHEMA_VERSION = 1
+
+def file_sha1(path, chunk_size=1024*1024):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Manifest:
+    '''
+    path (relative to the device root) -> sha1, size and mtime of
+    the file as calibre last wrote it.  Read whole when opened,
+    changes are written in one transaction by commit().
+    '''
+
+    def __init__(self, sqlite_path):
+        self.sqlite_path = sqlite_path
+        self.entries = {}
+        self.changes = {}
+        self.db = None
+
+    def open(self):
+        self.db = apsw.Connection(self.sqlite_path)
+        version = self.db.execute('pragma user_version').fetchall()[0][0]
+        if version < 1:
+            with self.db:
+                self.db.execute('''create table if not exists manifest (
+                                     path text primary key,
+                                     sha1 text not null,
+                                     size integer not null,
+                                     mtime_ns integer not null)''')
+                self.db.execute('pragma user_version = %d'%SCHEMA_VERSION)
+        for path, sha1, size, mtime_ns in self.db.execute(
+                'select path, sha1, size, mtime_ns from manifest'):
+            self.entries[path] = (sha1, size, mtime_ns)
+        return self
+
+    def unchanged(self, relpath, sha1, stat):
+        '''
+        True if the file at relpath, with os.stat() result stat, is
+        still the one written with content sha1.
+        '''
+        entry = self.entries.get(relpath)
+        return (entry is not None and stat is not None and
+                entry == (sha1, stat.st_size, stat.st_mtime_ns))
+
+    def record(self, relpath, sha1, stat):
+        self.entries[relpath] = self.changes[relpath] = (sha1, stat.st_size, stat.st_mtime_ns)
+
+    def commit(self):
+        if self.changes:
+            with self.db:
+                self.db.executemany('insert or replace into manifest (path, sha1, size, mtime_ns) values (?, ?, ?, ?)',
+                                    [ (path,) + entry for path, entry in self.changes.items() ])
+            self.changes = {}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
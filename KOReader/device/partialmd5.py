@@ -0,0 +1,130 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""KOReader's partial MD5 book digest, and the places KOReader keeps it."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import os
+import re
+import json
+import apsw
+
+import logging
+logger = logging.getLogger(__name__)
+
+from calibre_plugins.koreader.luadata.io.write import atomic_open
+from calibre_plugins.koreader.stats.digest import partial_md5
+
+_MD5_RE = re.compile(br'(\["partial_md5_checksum"\]\s*=\s*)"[^"\\\n]*"')
+_RETURN_RE = re.compile(br'return\s*\{')
+
+def sidecar_path(book_path):
+    '''
+    Where KOReader keeps a book's settings when they're kept next to
+    the book: /x/12805.epub -> /x/12805.sdr/metadata.epub.lua
+    '''
+    base, ext = os.path.splitext(book_path)
+    return os.path.join(base + '.sdr', 'metadata.%s.lua'%(ext[1:] or '_'))
+
+def set_sidecar_md5(path, md5):
+    '''
+    Set partial_md5_checksum in the sidecar at path, in place so
+    the rest of the file is left exactly as KOReader wrote it.
+    Missing sidecars aren't created, KOReader takes a book with one
+    as already opened.  Returns True if the file was changed.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            text = f.read()
+    except FileNotFoundError:
+        return False
+    value = b'"' + md5.encode('ascii') + b'"'
+    m = _MD5_RE.search(text)
+    if m:
+        if text[m.end(1):m.end()] == value:
+            return False
+        text = text[:m.end(1)] + value + text[m.end():]
+    else:
+        m = _RETURN_RE.search(text)
+        if not m:
+            logger.debug("Can't find the table in '%s'"%path)
+            return False
+        text = text[:m.end()] + b'\n    ["partial_md5_checksum"] = ' + value + b',' + text[m.end():]
+    logger.debug("partial_md5_checksum %s in '%s'"%(md5, path))
+    with atomic_open(path, 'wb') as f:
+        f.write(text)
+    return True
+
+class DigestCache:
+    '''
+    Partial md5 of the books on a device, by path relative to the
+    device root, kept locally with the (size, mtime_ns) they were
+    computed at.  A book is only hashed again once it changes.
+    '''
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(cache_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def record(self, relpath, stat, md5):
+        entry = [stat.st_size, stat.st_mtime_ns, md5]
+        if self.entries.get(relpath) != entry:
+            self.entries[relpath] = entry
+            self.changed = True
+
+    def digest(self, root, relpath):
+        '''partial_md5 of root/relpath, hashed only when not known.'''
+        path = os.path.join(root, *relpath.split('/'))
+        stat = os.stat(path)
+        entry = self.entries.get(relpath)
+        if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        md5 = partial_md5(path)
+        self.record(relpath, stat, md5)
+        return md5
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with atomic_open(self.cache_path, 'w') as f:
+                json.dump(self.entries, f)
+            self.changed = False
+        except OSError as e:
+            logger.debug("Can't save digests '%s': %s"%(self.cache_path, e))
+
+def set_stats_md5(stats_sql_path, uuid_md5s):
+    '''
+    Set the md5 of the statistics.sqlite3 book rows the
+    2-statistics-with-uuid-key.lua patch's uuid table maps the
+    calibre uuids to.  uuid_md5s is a list of (uuid, md5).  Does
+    nothing without the uuid table.  Rows another book with the
+    same title and authors already has the md5 of are left alone,
+    KOReader's book table is unique on the three.  Returns the rows
+    changed.
+    '''
+    if not uuid_md5s:
+        return 0
+    db = apsw.Connection(stats_sql_path)
+    try:
+        if not db.execute("select 1 from sqlite_master where type='table' and name='uuid'").fetchall():
+            logger.debug("No uuid table in '%s'"%stats_sql_path)
+            return 0
+        before = db.totalchanges()
+        with db:
+            db.executemany('''update or ignore book set md5=?
+                              where id in (select id_book from uuid where uuid=?)
+                                and md5 is not ?''',
+                           [ (md5, 'calibre:'+uuid, md5) for uuid, md5 in uuid_md5s ])
+        return db.totalchanges() - before
+    finally:
+        db.close()
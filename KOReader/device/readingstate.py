@@ -0,0 +1,92 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""Reading state of books, from their KOReader sidecars, as calibre column values."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+from datetime import datetime, timezone
+
+## the kinds of reading state that can go to a column.
+PERCENT    = 'percent'
+STATUS     = 'status'
+LAST_READ  = 'last_read'
+HIGHLIGHTS = 'highlights'
+## from KOReader's statistics, see stats.importer
+READ_TIME  = 'read_time'
+PAGES_READ = 'pages_read'
+SESSIONS   = 'sessions'
+
+def count_highlights(data):
+    '''
+    Newer KOReader keeps a list of annotations, older ones a
+    table of highlights per page.  An empty lua table comes back
+    as an empty list either way.
+    '''
+    annotations = data.get('annotations')
+    if isinstance(annotations, (list, dict)) and annotations:
+        return len(annotations)
+    highlight = data.get('highlight')
+    if isinstance(highlight, dict):
+        highlight = list(highlight.values())
+    if isinstance(highlight, list):
+        return sum(len(page) for page in highlight if isinstance(page, (list, dict)))
+    return 0
+
+def reading_state(data, last_read=None):
+    '''
+    Reading state of one book from its parsed sidecar.  last_read
+    is the epoch time KOReader's history.lua has for it, if any.
+    '''
+    summary = data.get('summary')
+    if not isinstance(summary, dict):
+        summary = {}
+    return {
+        PERCENT: data.get('percent_finished'),
+        STATUS: summary.get('status'),
+        LAST_READ: last_read,
+        HIGHLIGHTS: count_highlights(data),
+        }
+
+def column_value(datatype, kind, value):
+    '''
+    value converted for a calibre column of datatype, None when
+    there's nothing to set or the column type doesn't fit.
+    '''
+    if value is None:
+        return None
+    if kind == PERCENT:
+        if not isinstance(value, (int, float)):
+            return None
+        if datatype == 'int':
+            return int(round(value * 100))
+        if datatype == 'float':
+            return round(value * 100, 1)
+        if datatype in ('text', 'comments'):
+            return '%d%%'%int(round(value * 100))
+    elif kind == STATUS:
+        if datatype == 'bool':
+            return value == 'complete'
+        if datatype in ('text', 'comments', 'enumeration'):
+            return value
+    elif kind == LAST_READ:
+        when = datetime.fromtimestamp(value, tz=timezone.utc)
+        if datatype == 'datetime':
+            return when
+        if datatype in ('text', 'comments'):
+            return when.isoformat()
+    elif kind == READ_TIME:
+        ## seconds, as minutes or h:mm
+        if datatype == 'int':
+            return int(round(value / 60))
+        if datatype == 'float':
+            return round(value / 60, 1)
+        if datatype in ('text', 'comments'):
+            return '%d:%02d'%(value // 3600, value % 3600 // 60)
+    elif kind in (HIGHLIGHTS, PAGES_READ, SESSIONS):
+        if datatype in ('int', 'float'):
+            return value
+        if datatype in ('text', 'comments'):
+            return str(value)
+    return None
@@ -0,0 +1,171 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""KOReader updates collected over a device session."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger(__name__)
+
+class PendingUpdates:
+    '''
+    What KOReader's files still need for the books sent so far:
+    bookinfo rows to prefill or remove, history bumps and partial
+    md5 digests.
+    '''
+
+    def __init__(self):
+        self.cache_sql_path = None
+        self.history_lua_path = None
+        ## (directory, filename) -> bookinfo row to prefill, or None
+        ## to just remove the cached row.
+        self.bookinfo = OrderedDict()
+        ## most recently sent first, like they end up in history.
+        self.bump_filepaths = []
+        self.stats_sql_path = None
+        ## local path of the book on the device -> (calibre uuid,
+        ## KOReader partial md5)
+        self.md5s = OrderedDict()
+
+    def __bool__(self):
+        return bool(self.bookinfo or self.bump_filepaths or self.md5s)
+
+    def add(self, cache_sql_path, bookinfo, history_lua_path, bump_filepaths,
+            stats_sql_path=None, md5s=()):
+        '''
+        bookinfo is a list of ((directory, filename), row or None).
+        A later send of the same book replaces what an earlier one
+        queued, and its bumps go in front of the earlier ones.
+        md5s is a list of (book path, calibre uuid, partial md5).
+        '''
+        if cache_sql_path:
+            self.cache_sql_path = cache_sql_path
+            for key, row in bookinfo:
+                self.bookinfo.pop(key, None)
+                self.bookinfo[key] = row
+        if history_lua_path and bump_filepaths:
+            self.history_lua_path = history_lua_path
+            self.bump_filepaths = list(bump_filepaths) + [
+                b for b in self.bump_filepaths if b not in bump_filepaths ]
+        if stats_sql_path:
+            self.stats_sql_path = stats_sql_path
+        for path, uuid, md5 in md5s:
+            self.md5s[path] = (uuid, md5)
+
+    def prefill_rows(self):
+        return [ row for row in self.bookinfo.values() if row is not None ]
+
+    def invalidate_paths(self):
+        return [ key for key, row in self.bookinfo.items() if row is None ]
+
+class Worker:
+    '''
+    A background thread running the tasks submitted to it one at a
+    time, in order, so device bookkeeping doesn't hold up the
+    device job that queued it.  Failures are logged and kept for
+    take_errors().
+    '''
+
+    def __init__(self, name='KOReader worker'):
+        self.name = name
+        self.tasks = queue.Queue()
+        self.thread = None
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def submit(self, description, func, *args):
+        self.tasks.put((description, func, args))
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            description, func, args = self.tasks.get()
+            try:
+                logger.debug("%s: %s (%d more queued)"%(self.name, description, self.tasks.qsize()))
+                func(*args)
+            except Exception as e:
+                logger.exception("%s: %s failed: %s"%(self.name, description, e))
+                with self.lock:
+                    self.errors.append((description, e))
+            finally:
+                self.tasks.task_done()
+
+    def take_errors(self):
+        '''(description, exception) of the tasks failed since the last call.'''
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def wait(self):
+        '''Block until every submitted task is done.'''
+        self.tasks.join()
+
+    def cancel(self):
+        '''Drop the tasks not started yet.'''
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except queue.Empty:
+                return
+            self.tasks.task_done()
+
+class SessionQueue:
+    '''
+    Collects PendingUpdates from every upload_books call of a
+    device session and hands them to flush_func all at once: when
+    flush() is called, at eject, or once no books were sent for
+    idle_timeout seconds.  0 waits for an explicit flush.  Nothing
+    runs on a timer of its own, idle_flush() is called from
+    calibre's device thread and flushes when the time is up.
+    '''
+
+    def __init__(self, flush_func, idle_timeout=0):
+        self.flush_func = flush_func
+        self.idle_timeout = idle_timeout
+        self.lock = threading.RLock()
+        ## time.monotonic() after which idle_flush flushes.
+        self.deadline = None
+        self.pending = PendingUpdates()
+
+    def add(self, *args):
+        with self.lock:
+            self.pending.add(*args)
+            self.deadline = None
+            if self.idle_timeout > 0 and self.pending:
+                self.deadline = time.monotonic() + self.idle_timeout
+
+    def flush(self):
+        '''Run flush_func on everything pending, if anything is.'''
+        with self.lock:
+            self.deadline = None
+            pending, self.pending = self.pending, PendingUpdates()
+            if pending:
+                self.flush_func(pending)
+
+    def idle_flush(self, now=None):
+        '''
+        Flush if idle_timeout has passed since the last add.
+        Returns True if it did.
+        '''
+        with self.lock:
+            if self.deadline is None or (now or time.monotonic()) < self.deadline:
+                return False
+            self.flush()
+            return True
+
+    def discard(self):
+        '''Forget everything pending, the device is gone.'''
+        with self.lock:
+            self.deadline = None
+            self.pending = PendingUpdates()
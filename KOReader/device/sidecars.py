@@ -0,0 +1,129 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""Index of the KOReader .sdr sidecar files on the device."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import os
+import marshal
+
+import logging
+logger = logging.getLogger(__name__)
+
+from calibre_plugins.koreader import luadata
+from calibre_plugins.koreader.luadata.io.write import atomic_open
+
+## bump when the saved index layout changes.
+INDEX_VERSION = 1
+
+def find_sidecars(root):
+    '''
+    Yield (relative path, (size, mtime_ns)) of every metadata.*.lua
+    in a .sdr dir under root.  Paths use / on every platform.
+    '''
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(root, reldir)))
+        except OSError as e:
+            logger.debug("Can't scan '%s': %s"%(reldir, e))
+            continue
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            relpath = reldir + entry.name
+            if not entry.name.endswith('.sdr'):
+                stack.append(relpath + '/')
+                continue
+            try:
+                sdr_entries = list(os.scandir(entry.path))
+            except OSError:
+                continue
+            for sdr_entry in sdr_entries:
+                name = sdr_entry.name
+                if name.startswith('metadata.') and name.endswith('.lua') and sdr_entry.is_file():
+                    stat = sdr_entry.stat()
+                    yield relpath + '/' + name, (stat.st_size, stat.st_mtime_ns)
+
+def book_path(sidecar_relpath):
+    '''
+    The book a sidecar belongs to:
+    'calibre/12805.sdr/metadata.epub.lua' -> 'calibre/12805.epub'
+    '''
+    sdr_dir, name = sidecar_relpath.rsplit('/', 1)
+    ext = name[len('metadata.'):-len('.lua')]
+    return sdr_dir[:-len('.sdr')] + '.' + ext
+
+class SidecarIndex:
+    '''
+    The parsed sidecars of every book on a device, saved locally
+    between connects so a scan only parses the sidecars that were
+    added or changed since the last one.
+    '''
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        ## relative sidecar path -> (size, mtime_ns, data)
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                version, entries = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if version == INDEX_VERSION:
+            self.entries = entries
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with atomic_open(self.index_path, 'wb') as f:
+                marshal.dump((INDEX_VERSION, self.entries), f)
+        except OSError as e:
+            logger.debug("Can't save sidecar index '%s': %s"%(self.index_path, e))
+
+    def scan(self, root, max_workers=1, mp_context=None):
+        '''
+        Bring the index up to date with the sidecars under root.
+        Returns the relative paths of the sidecars (re)parsed.
+        '''
+        found = dict(find_sidecars(root))
+        changed = [ relpath for relpath, stamp in found.items()
+                    if relpath not in self.entries or self.entries[relpath][:2] != stamp ]
+        removed = [ relpath for relpath in self.entries if relpath not in found ]
+
+        def on_error(path, e):
+            logger.debug("Can't read sidecar '%s': %s"%(path, e))
+        paths = [ os.path.join(root, relpath) for relpath in changed ]
+        data = luadata.read_many(paths, encoding="utf-8", max_workers=max_workers,
+                                 mp_context=mp_context, on_error=on_error)
+
+        parsed = []
+        for relpath, path in zip(changed, paths):
+            if path in data:
+                self.entries[relpath] = found[relpath] + (data[path],)
+                parsed.append(relpath)
+            else:
+                ## retried on the next scan
+                self.entries.pop(relpath, None)
+        for relpath in removed:
+            del self.entries[relpath]
+        if changed or removed:
+            self.save()
+        logger.debug("Sidecar scan: %d found, %d parsed, %d removed"%(len(found), len(parsed), len(removed)))
+        return parsed
+
+    def get(self, relpath):
+        '''Parsed sidecar data, or None.'''
+        entry = self.entries.get(relpath)
+        return entry[2] if entry else None
+
+    def books(self):
+        '''Yield (book path relative to root, sidecar relative path, data).'''
+        for relpath, (size, mtime_ns, data) in self.entries.items():
+            yield book_path(relpath), relpath, data
@@ -0,0 +1,81 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""Phase timings and counters of driver operations, kept to compare sessions."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import os
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+from calibre_plugins.koreader.luadata.io.write import atomic_open
+
+## the log is cut down to its newer half past this size.
+MAX_LOG_BYTES = 1024*1024
+
+class Timings:
+    '''
+    Seconds spent in each named phase of one operation, and
+    counters of what it did.  Phases entered more than once add
+    up.
+    '''
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.started = time.time()
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self):
+        return OrderedDict([
+                ('operation', self.operation),
+                ('started', round(self.started, 3)),
+                ('phases', OrderedDict( (name, round(secs, 4)) for name, secs in self.phases.items() )),
+                ('counters', self.counters),
+                ])
+
+    def report(self, log_path=None):
+        '''Log the timings, and append them to the JSON lines file log_path.'''
+        phases = ' '.join( '%s=%.3fs'%(name, secs) for name, secs in self.phases.items() )
+        counters = ' '.join( '%s=%s'%(name, n) for name, n in self.counters.items() )
+        logger.info("%s: %s %s"%(self.operation, phases, counters))
+        if log_path:
+            try:
+                append_log(log_path, self.record())
+            except OSError as e:
+                logger.debug("Can't save timings to '%s': %s"%(log_path, e))
+
+def append_log(log_path, record, max_bytes=MAX_LOG_BYTES):
+    '''
+    Append record as one JSON line.  Once the file is bigger than
+    max_bytes its older half is dropped.
+    '''
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+        size = f.tell()
+    if size > max_bytes:
+        with open(log_path, 'rb') as f:
+            f.seek(size - max_bytes // 2)
+            f.readline() # partial line
+            tail = f.read()
+        with atomic_open(log_path, 'wb') as f:
+            f.write(tail)
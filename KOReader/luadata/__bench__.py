@@ -0,0 +1,200 @@
+"""Offline benchmarks for the luadata parser and serializer.
+
+Run from the directory holding the luadata package::
+
+    python -m luadata.__bench__
+    python -m luadata.__bench__ --sizes 1000 10000 --save-baseline
+
+Synthetic KOReader history, book sidecar and settings tables are built at
+each size.  unserialize/serialize/read/write throughput (MB/s of lua text)
+and peak traced memory are compared against the stored baseline, the exit
+status is 1 if anything got slower or bigger than the tolerance allows.
+Baselines are machine specific, save one before changing the code.
+"""
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from . import read, serialize, unserialize, write
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__bench__.json")
+
+
+def history(size):
+    """history.lua: the recently opened books."""
+    return [
+        {"file": "/mnt/onboard/calibre/Author %d/Title %d.epub" % (i % 97, i), "time": 1700000000 + i}
+        for i in range(size)
+    ]
+
+
+def sidecar(size):
+    """metadata.epub.lua with `size` highlights."""
+    return {
+        "annotations": [
+            {
+                "chapter": "Chapter %d" % (i // 50),
+                "color": "yellow",
+                "datetime": "2025-06-%02d 12:%02d:%02d" % (i % 28 + 1, i % 60, i % 60),
+                "drawer": "lighten",
+                "page": "/body/DocFragment[%d]/body/p[%d]/text().%d" % (i // 50, i % 50, i),
+                "pageno": i // 3,
+                "pos0": "/body/DocFragment[%d]/body/p[%d]/text().0" % (i // 50, i % 50),
+                "pos1": "/body/DocFragment[%d]/body/p[%d]/text().%d" % (i // 50, i % 50, i),
+                "text": 'Highlighted "passage" number %d,\nwith a line break.' % i,
+            }
+            for i in range(size)
+        ],
+        "doc_pages": size // 3 + 1,
+        "doc_path": "/mnt/onboard/calibre/Author/Title.epub",
+        "doc_props": {"authors": "Author", "language": "en", "title": "Title"},
+        "partial_md5_checksum": "0123456789abcdef0123456789abcdef",
+        "percent_finished": 0.5,
+        "stats": {"highlights": size, "notes": 0, "pages": size // 3 + 1},
+        "summary": {"modified": "2025-06-01", "status": "reading"},
+    }
+
+
+def settings(size):
+    """settings.reader.lua style flat table of mixed values."""
+    data = {}
+    for i in range(size):
+        kind = i % 4
+        if kind == 0:
+            data["option_%d" % i] = bool(i % 3)
+        elif kind == 1:
+            data["number_%d" % i] = i * 1.5
+        elif kind == 2:
+            data["path_%d" % i] = "/mnt/onboard/.adds/koreader/%d" % i
+        else:
+            data["list_%d" % i] = [i, i + 1, "x%d" % i]
+    return data
+
+
+DATASETS = {"history": history, "sidecar": sidecar, "settings": settings}
+
+
+def best_of(repeat, func):
+    """Fastest of repeat runs of func, in seconds."""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(func):
+    """Peak traced memory allocated while running func, in KiB."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+def bench(name, size, repeat, workdir):
+    """Results of every operation on one dataset, keyed "name/size/op"."""
+    data = DATASETS[name](size)
+    text = "return " + serialize(data, indent="\t")
+    nbytes = len(text.encode("utf-8"))
+    path = os.path.join(workdir, "%s-%d.lua" % (name, size))
+    write(path, data, indent="\t")
+    out_path = os.path.join(workdir, "out.lua")
+
+    def write_fresh():
+        # write skips unchanged files, start from scratch every time
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        write(out_path, data, indent="\t")
+
+    operations = {
+        "unserialize": lambda: unserialize(text),
+        "serialize": lambda: serialize(data, indent="\t"),
+        "read": lambda: read(path),
+        "write": write_fresh,
+    }
+    results = {}
+    for op, func in operations.items():
+        seconds = best_of(repeat, func)
+        results["%s/%d/%s" % (name, size, op)] = {
+            "mbps": round(nbytes / seconds / 1e6, 3),
+            "peak_kib": round(peak_memory(func), 1),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print results next to the baseline, return the regressed keys."""
+    regressions = []
+    print("%-28s %10s %10s %7s %12s %12s" % ("benchmark", "MB/s", "base", "ratio", "peak KiB", "base"))
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            print("%-28s %10.2f %10s %7s %12.1f %12s" % (key, result["mbps"], "-", "-", result["peak_kib"], "-"))
+            continue
+        ratio = result["mbps"] / base["mbps"]
+        flag = ""
+        if ratio < 1 - tolerance or result["peak_kib"] > base["peak_kib"] * (1 + tolerance):
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(
+            "%-28s %10.2f %10.2f %7.2f %12.1f %12.1f%s"
+            % (key, result["mbps"], base["mbps"], ratio, result["peak_kib"], base["peak_kib"], flag)
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m luadata.__bench__", description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--datasets", nargs="+", choices=sorted(DATASETS), default=sorted(DATASETS))
+    parser.add_argument("--repeat", type=int, default=3, help="runs per timing, the best counts")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown or growth")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    workdir = tempfile.mkdtemp()
+    try:
+        results = {}
+        for name in args.datasets:
+            for size in args.sizes:
+                results.update(bench(name, size, args.repeat, workdir))
+    finally:
+        shutil.rmtree(workdir)
+
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print("baseline saved to %s" % args.baseline)
+        return 0
+    if regressions:
+        print("%d regression(s) beyond %d%%" % (len(regressions), args.tolerance * 100))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,9 @@
-from .serializer.serialize import serialize
+from .serializer.serialize import serialize, serialize_to
 from .serializer.unserialize import unserialize
-from .io.read import read
+from .io.read import read, read_many
 from .io.write import write
+from .io.iterparse import iterparse
+from .io.cache import ReadCache
 
 name = "luadata"
 
@@ -0,0 +1,230 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+from luadata import ReadCache, iterparse, read, read_many, write
+from luadata.io.read import MIN_PARALLEL
+from luadata.io.write import atomic_open
+
+
+class TestIterparseMethods(unittest.TestCase):
+    def write_file(self, data):
+        fd, path = tempfile.mkstemp(suffix=".lua")
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        return path
+
+    def iterparse(self, text, chunk_size=3):
+        return list(iterparse(self.write_file(text.encode("utf-8")), chunk_size=chunk_size))
+
+    def test_list(self):
+        self.assertEqual(self.iterparse("return {1, 2.5, 'a', true}"), [1, 2.5, "a", True])
+        self.assertEqual(self.iterparse("return {}"), [])
+        self.assertEqual(self.iterparse("{{1},{a=1,},}"), [[1], {"a": 1}])
+
+    def test_keyed(self):
+        self.assertEqual(
+            self.iterparse('return {\n    [1] = {\n        ["file"] = "/a",\n    },\n    [2] = 3,\n}\n'),
+            [{"file": "/a"}, 3],
+        )
+
+    def test_strings_and_comments(self):
+        self.assertEqual(
+            self.iterparse('-- header\nreturn { "a,}", --[[ x,} ]] "b\\"{", -- c,}\n "c" }'),
+            ["a,}", 'b"{', "c"],
+        )
+
+    def test_chunk_sizes(self):
+        text = 'return {\n    [1] = {\n        ["file"] = "/a-b,}",\n        ["time"] = 1,\n    },\n'
+        text += '    [2] = { x = { "{" } },\n    [3] = { y = 1 -- c }\n },\n    [4] = \'}\',\n}\n'
+        expected = [{"file": "/a-b,}", "time": 1}, {"x": ["{"]}, {"y": 1}, "}"]
+        for chunk_size in (1, 7, 64 * 1024):
+            self.assertEqual(self.iterparse(text, chunk_size=chunk_size), expected)
+
+    def test_stop_early(self):
+        path = self.write_file(b"return {1, 2, 3, broken")
+        items = []
+        for item in iterparse(path, chunk_size=2):
+            items.append(item)
+            if item == 2:
+                break
+        self.assertEqual(items, [1, 2])
+
+    def test_errors(self):
+        for text in ["return {1", 'return {"a}', "return {1,,2}", "x {1}", ""]:
+            with self.assertRaises(Exception):
+                self.iterparse(text)
+
+
+class TestReadMethods(unittest.TestCase):
+    def read(self, data, **kwargs):
+        fd, path = tempfile.mkstemp(suffix=".lua")
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        return read(path, **kwargs)
+
+    def test_return(self):
+        self.assertEqual(self.read(b"  return {1, 'a'}\n"), [1, "a"])
+        self.assertEqual(self.read(b"{1}"), [1])
+        self.assertEqual(self.read(b"return 1, 2", multival=True), (1, 2))
+
+    def test_encoding(self):
+        self.assertEqual(self.read('return {"乗"}'.encode("utf-8")), ["乗"])
+        self.assertEqual(self.read('return {"乗\\"}'.encode("gbk"), encoding="gbk"), ["乗"])
+
+    def test_errors(self):
+        for data in [b"", b"returnx {1}", b"return {1"]:
+            with self.assertRaises(Exception):
+                self.read(data)
+
+
+class TestReadManyMethods(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write_files(self, count):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.dir, "%d.lua" % i)
+            write(path, {"i": i, "s": "乗" * i})
+            paths.append(path)
+        return paths
+
+    def test_parallel(self):
+        paths = self.write_files(40)
+        expected = {path: {"i": i, "s": "乗" * i} for i, path in enumerate(paths)}
+        self.assertEqual(read_many(paths, max_workers=2), expected)
+        self.assertEqual(list(read_many(paths, max_workers=1)), paths)
+
+    def test_cache(self):
+        paths = self.write_files(3)
+        cache = ReadCache()
+        read_many(paths, cache=cache)
+        self.assertEqual(cache.get(paths[2]), {"i": 2, "s": "乗乗"})
+
+    def test_errors(self):
+        paths = self.write_files(2)
+        with open(paths[0], "w") as file:
+            file.write("return {")
+        with self.assertRaises(Exception):
+            read_many(paths)
+        errors = []
+        results = read_many(paths, on_error=lambda path, err: errors.append(path))
+        self.assertEqual(errors, [paths[0]])
+        self.assertEqual(list(results), [paths[1]])
+
+    def test_error_types(self):
+        paths = self.write_files(MIN_PARALLEL)
+        with open(paths[0], "w") as file:
+            file.write("return {")
+        os.remove(paths[1])
+        for max_workers in (1, 2):
+            errors = {}
+            read_many(paths, max_workers=max_workers, on_error=lambda path, err: errors.update({path: err}))
+            self.assertIsInstance(errors[paths[1]], FileNotFoundError)
+            self.assertNotIsInstance(errors[paths[0]], OSError)
+
+
+class TestWriteMethods(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "history.lua")
+
+    def test_round_trip(self):
+        data = [{"file": "/a/乗.epub", "time": 1}, {"file": 'b"\\\n', "time": 2}]
+        write(self.path, data, indent="\t")
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(8), b"return {")
+        self.assertEqual(read(self.path), data)
+        self.assertEqual(list(iterparse(self.path)), data)
+
+    def test_skip_unchanged(self):
+        data = {"a": [1, 2, "乗"]}
+        self.assertTrue(write(self.path, data, indent="\t"))
+        os.utime(self.path, ns=(0, 0))
+        self.assertFalse(write(self.path, data, indent="\t"))
+        self.assertEqual(os.stat(self.path).st_mtime_ns, 0)
+        self.assertTrue(write(self.path, data))
+        self.assertEqual(read(self.path), data)
+        self.assertEqual(os.listdir(self.dir), ["history.lua"])
+
+    def test_failed_write(self):
+        write(self.path, [1, 2])
+        with self.assertRaises(ZeroDivisionError):
+            with atomic_open(self.path) as file:
+                file.write("return {")
+                1 / 0
+        self.assertEqual(read(self.path), [1, 2])
+        self.assertEqual(os.listdir(self.dir), ["history.lua"])
+
+
+class TestReadCacheMethods(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "history.lua")
+        self.cache_dir = os.path.join(self.dir, "cache")
+
+    def test_memory(self):
+        cache = ReadCache()
+        write(self.path, [{"file": "/a"}])
+        self.assertIsNone(cache.get(self.path))
+        data = read(self.path, cache=cache)
+        data[0]["file"] = "/b"
+        self.assertEqual(cache.get(self.path), [{"file": "/a"}])
+        self.assertEqual(read(self.path, cache=cache), [{"file": "/a"}])
+        write(self.path, [{"file": "/c"}], cache=cache)
+        self.assertIsNone(cache.get(self.path))
+        self.assertEqual(read(self.path, cache=cache), [{"file": "/c"}])
+
+    def test_changed_stamp(self):
+        cache = ReadCache()
+        write(self.path, [1])
+        read(self.path, cache=cache)
+        with open(self.path, "w") as file:
+            file.write("return {2, 3}")
+        self.assertEqual(read(self.path, cache=cache), [2, 3])
+
+    def test_replaced_while_read(self):
+        cache = ReadCache(cache_dir=self.cache_dir)
+        write(self.path, [1])
+        stamp = (os.path.getsize(self.path), os.stat(self.path).st_mtime_ns)
+        with open(self.path, "w") as file:
+            file.write("return {2, 3}")
+        cache.put(self.path, [1], stamp=stamp)
+        self.assertIsNone(cache.get(self.path))
+        self.assertIsNone(ReadCache(cache_dir=self.cache_dir).get(self.path))
+        self.assertEqual(read(self.path, cache=cache), [2, 3])
+
+    def test_lru(self):
+        cache = ReadCache(maxsize=1)
+        other = os.path.join(self.dir, "other.lua")
+        write(self.path, [1])
+        write(other, [2])
+        read(self.path, cache=cache)
+        read(other, cache=cache)
+        self.assertIsNone(cache.get(self.path))
+        self.assertEqual(cache.get(other), [2])
+
+    def test_sidecar(self):
+        write(self.path, {"a": ["乗", 1.5, True]})
+        read(self.path, cache=ReadCache(cache_dir=self.cache_dir))
+        cache = ReadCache(cache_dir=self.cache_dir)
+        self.assertEqual(cache.get(self.path), {"a": ["乗", 1.5, True]})
+        self.assertIsNone(cache.get(self.path, multival=True))
+        cache.invalidate(self.path)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertIsNone(ReadCache(cache_dir=self.cache_dir).get(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import contextlib
+import hashlib
+import marshal
+import os
+from collections import OrderedDict
+from .write import atomic_open
+
+# bumped whenever the sidecar layout or the unserialized values change
+SIDECAR_VERSION = 1
+
+
+class ReadCache:
+    """Parsed luadata files, keyed by real path, size and mtime.
+
+    Values are kept as marshal blobs, every hit returns a fresh copy that the
+    caller is free to modify.  With a `cache_dir` each parse is also saved as
+    a sidecar file there, so an unchanged file is only stat'ed even in a new
+    process.
+
+    File systems with a coarse mtime (FAT has two seconds) can miss a rewrite
+    of the same size, writers should call `invalidate` or `put` afterwards.
+    """
+
+    def __init__(self, maxsize=8, cache_dir=None):
+        """
+        Args:
+            maxsize (int, optional): parsed files kept in memory. Defaults to 8.
+            cache_dir (str, optional): directory for sidecar files. Defaults to None, memory only.
+        """
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+
+    def get(self, path, encoding="utf-8", multival=False):
+        """Return a copy of the cached value for path, None on a miss."""
+        path = os.path.realpath(path)
+        ident = (path, encoding, multival)
+        stamp = _stamp(path)
+        entry = self.entries.get(ident)
+        if entry is not None and entry[0] == stamp:
+            self.entries.move_to_end(ident)
+            return marshal.loads(entry[1])
+        blob = self._load_sidecar(ident, stamp)
+        if blob is None:
+            return None
+        self._remember(ident, stamp, blob)
+        return marshal.loads(blob)
+
+    def put(self, path, value, encoding="utf-8", multival=False, stamp=None):
+        """Remember value as the content of the file currently at path.
+
+        Args:
+            stamp (tuple, optional): `(size, mtime_ns)` of the file taken before
+                value was read from it.  value is not cached when the file has
+                changed since.  Defaults to None, value is the current content.
+        """
+        path = os.path.realpath(path)
+        ident = (path, encoding, multival)
+        current = _stamp(path)
+        if stamp is not None and stamp != current:
+            return
+        stamp = current
+        blob = marshal.dumps(value)
+        self._remember(ident, stamp, blob)
+        self._save_sidecar(ident, stamp, blob)
+
+    def invalidate(self, path):
+        """Forget everything cached for path."""
+        path = os.path.realpath(path)
+        for ident in [ident for ident in self.entries if ident[0] == path]:
+            del self.entries[ident]
+        if self.cache_dir is None:
+            return
+        with contextlib.suppress(OSError):
+            os.remove(self._sidecar_path(path))
+
+    def clear(self):
+        self.entries.clear()
+
+    def _remember(self, ident, stamp, blob):
+        self.entries[ident] = (stamp, blob)
+        self.entries.move_to_end(ident)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _sidecar_path(self, path):
+        # one sidecar per file, the last parse wins
+        name = hashlib.sha1(path.encode("utf-8", "surrogateescape")).hexdigest()
+        return os.path.join(self.cache_dir, name + ".marshal")
+
+    def _load_sidecar(self, ident, stamp):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._sidecar_path(ident[0]), "rb") as file:
+                version, saved_ident, saved_stamp, blob = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if version != SIDECAR_VERSION or saved_ident != ident or saved_stamp != stamp:
+            return None
+        return blob
+
+    def _save_sidecar(self, ident, stamp, blob):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with atomic_open(self._sidecar_path(ident[0]), "wb") as file:
+                marshal.dump((SIDECAR_VERSION, ident, stamp, blob), file)
+        except OSError:  # the cache is only an optimization
+            pass
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
@@ -0,0 +1,176 @@
+import re
+from ..serializer.unserialize import unserialize
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_SPACE_RE = re.compile(rb"[ \t\r\n]+")
+_PLAIN_RE = re.compile(rb"[^-{}\"',= \t\r\n]+")
+_STRING_RES = {
+    ord('"'): re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.S),
+    ord("'"): re.compile(rb"'[^'\\]*(?:\\.[^'\\]*)*'", re.S),
+}
+_SPACE = frozenset(b" \t\r\n")
+# A whole element without comments or nested tables, followed by its "," or
+# "}".  Group 1 is the key up to "=", group 2 the value.
+_ELEMENT_RE = re.compile(
+    rb"[ \t\r\n]*"
+    rb"((?:\[[ \t\r\n]*(?:-?[0-9]+|\"[^\"\\]*(?:\\.[^\"\\]*)*\")[ \t\r\n]*\]"
+    rb"|[A-Za-z_][A-Za-z0-9_]*)[ \t\r\n]*=)?[ \t\r\n]*"
+    rb"(\{[^-{}\"']*"
+    rb"(?:(?:\"[^\"\\]*(?:\\.[^\"\\]*)*\"|'[^'\\]*(?:\\.[^'\\]*)*'|-(?!-))[^-{}\"']*)*\}"
+    rb"|\"[^\"\\]*(?:\\.[^\"\\]*)*\"|'[^'\\]*(?:\\.[^'\\]*)*'"
+    rb"|[^-{}\"',= \t\r\n]+)"
+    rb"[ \t\r\n]*(?=[,}])",
+    re.S,
+)
+
+
+def iterspans(file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Find the elements of a top-level ``return { ... }`` lua table.
+
+    The file is read in chunks of at least `chunk_size` bytes and only
+    scanned for braces, strings, comments, commas and ``=``, so memory use is
+    bounded by the largest single element.  Reads grow with an element that
+    spans many chunks, so it is copied and rescanned a logarithmic number of
+    times, not once per chunk.
+
+    Args:
+        file (file): binary file object positioned at the start of the data
+        chunk_size (int, optional): bytes read at a time. Defaults to 64 KiB.
+
+    Raises:
+        Exception: the data is not a lua table or ends prematurely
+
+    Yields:
+        tuple(int, int, int, bytes): file offsets of the element start, of its
+            value (after ``[key] =`` if there is one) and of its end, and the
+            element bytes.
+    """
+    # trimmed in place, an element is not copied again on every read
+    buf = bytearray()
+    base = 0  # file offset of buf[0]
+    pos = 0
+    eof = False
+    depth = 0
+    prefix = []
+    start = None
+    value_start = None
+
+    while True:
+        end = -1
+        if pos < len(buf):
+            end = _token_end(buf, pos, eof)
+        if end < 0:
+            if not eof:
+                # only keep the element in progress, or the token being scanned
+                keep = pos if start is None else start - base
+                del buf[:keep]
+                chunk = file.read(max(chunk_size, len(buf)))
+                eof = not chunk
+                buf += chunk
+                base = base + keep
+                pos = pos - keep
+                continue
+            if pos < len(buf) and buf[pos] in _STRING_RES:
+                _raise(base + pos, "unexpected string ending: missing close quote.")
+            if pos < len(buf):
+                _raise(base + pos, "unterminated comment.")
+            if depth > 0:
+                _raise(base + pos, 'unexpected end of table, "}" expected.')
+            _raise(base + pos, "nothing can be unserialized from input.")
+
+        if depth == 1 and start is None:
+            # the usual flat element is skipped in one go, anything else
+            # goes through the tokens below
+            match = _ELEMENT_RE.match(buf, pos)
+            if match is not None:
+                if match.group(1) is None:
+                    start = base + match.start(2)
+                else:
+                    start = base + match.start(1)
+                    value_start = base + match.end(1)
+                pos = match.end()
+                continue
+
+        c = buf[pos]
+        offset = base + pos
+        if c in _SPACE or (c == 0x2D and buf[pos + 1 : pos + 2] == b"-"):
+            pass
+        elif c == 0x7B:  # {
+            if depth == 0 and b"".join(prefix) not in (b"", b"return"):
+                _raise(offset, 'only "return {" is supported at top level.')
+            if depth == 1 and start is None:
+                start = offset
+            depth = depth + 1
+        elif c == 0x7D:  # }
+            depth = depth - 1
+            if depth < 0:
+                _raise(offset, "unexpected table closing.")
+            if depth == 0:
+                if start is not None:
+                    yield start, value_start or start, offset, bytes(buf[start - base : pos])
+                return
+        elif depth == 0:
+            if c != 0x2D and _PLAIN_RE.match(buf, pos) is None:
+                _raise(offset, "top-level table expected.")
+            prefix.append(bytes(buf[pos:end]))
+        elif depth == 1 and start is None:
+            if c == 0x2C or c == 0x3D:  # , =
+                _raise(offset, "unexpected character.")
+            start = offset
+        elif depth == 1 and c == 0x2C:  # ,
+            yield start, value_start or start, offset, bytes(buf[start - base : pos])
+            start = None
+            value_start = None
+        elif depth == 1 and c == 0x3D and value_start is None:  # =
+            value_start = end + base
+        pos = end
+
+
+def iterparse(path, encoding="utf-8", chunk_size=DEFAULT_CHUNK_SIZE):
+    """Iterate the elements of a ``return { ... }`` luadata file
+
+    Each element is unserialized and yielded as soon as it is complete, so
+    the caller can stop early and the whole file never has to be in memory.
+    Explicit keys like ``[1] = {...}`` are dropped, elements come in file order.
+
+    Args:
+        path (str): file path
+        encoding (str, optional): file encoding. Defaults to "utf-8".
+        chunk_size (int, optional): bytes read at a time. Defaults to 64 KiB.
+
+    Yields:
+        *: unserialized element
+    """
+    with open(path, "rb") as file:
+        for start, value_start, end, data in iterspans(file, chunk_size):
+            yield unserialize(data[value_start - start :], encoding=encoding)
+
+
+def _token_end(buf, pos, eof):
+    """End of the token starting at pos, -1 when buf does not hold all of it."""
+    c = buf[pos]
+    if c in _SPACE:
+        return _SPACE_RE.match(buf, pos).end()
+    if c in _STRING_RES:
+        match = _STRING_RES[c].match(buf, pos)
+        return -1 if match is None else match.end()
+    if c == 0x2D:  # -
+        if len(buf) - pos < 4 and not eof:
+            return -1
+        if buf[pos + 1 : pos + 2] != b"-":
+            return pos + 1
+        if buf[pos + 2 : pos + 4] == b"[[":
+            close = buf.find(b"]]", pos + 4)
+            return -1 if close < 0 else close + 2
+        close = buf.find(b"\n", pos + 2)
+        if close < 0:
+            return len(buf) if eof else -1
+        return close + 1
+    if c in b"{},=":
+        return pos + 1
+    return _PLAIN_RE.match(buf, pos).end()
+
+
+def _raise(pos, errmsg):
+    raise Exception("Iterparse luadata failed on pos %d:\n    %s" % (pos, errmsg))
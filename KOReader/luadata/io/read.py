@@ -1,26 +1,129 @@
-import codecs
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from ..serializer.unserialize import unserialize
+from .cache import _stamp
 
+# below this many files starting worker processes costs more than it saves
+MIN_PARALLEL = 16
 
-def read(path, encoding="utf-8", multival=False):
+
+def read(path, encoding="utf-8", multival=False, cache=None):
     """Read luadata from file
 
+    The file is memory-mapped and parsed in place, without decoding or
+    copying it first.
+
     Args:
         path (str): file path
         encoding (str, optional): file encoding. Defaults to "utf-8".
+        multival (bool, optional): returns tuple for multiple return values. Defaults to False.
+        cache (ReadCache, optional): reuse the parse of an unchanged file. Defaults to None.
 
     Returns:
         tuple([*]): unserialized data from luadata file
     """
-    with codecs.open(path, "r", encoding) as file:
-        text = file.read().strip()
-        if text[0:6] == "return":
-            ch = text[6:7]
-            if not (
-                (ch >= "a" and ch <= "z")
-                or (ch >= "A" and ch <= "Z")
-                or (ch >= "0" and ch <= "9")
-                or ch == "_"
-            ):
-                text = text[6:]
-        return unserialize(text, encoding=encoding, multival=False)
+    stamp = None
+    if cache is not None:
+        data = cache.get(path, encoding=encoding, multival=multival)
+        if data is not None:
+            return data
+        # taken before the parse, a file replaced meanwhile is not cached
+        stamp = _stamp(path)
+    data = _read(path, encoding, multival)
+    if cache is not None:
+        cache.put(path, data, encoding=encoding, multival=multival, stamp=stamp)
+    return data
+
+
+def _read(path, encoding, multival):
+    with open(path, "rb") as file:
+        try:
+            buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files can not be mapped
+            return unserialize(b"", encoding=encoding, multival=multival)
+        try:
+            return unserialize(buf, encoding=encoding, multival=multival)
+        finally:
+            buf.close()
+
+
+def _read_one(args):
+    """Pool worker: (data, None) or (None, error) for one file.
+
+    The error is returned as raised, so callers can tell an OSError from a
+    parse error.
+    """
+    path, encoding, multival = args
+    try:
+        return _read(path, encoding, multival), None
+    except Exception as err:
+        return None, err
+
+
+def read_many(
+    paths, encoding="utf-8", multival=False, cache=None, max_workers=None, mp_context=None, on_error=None
+):
+    """Read many luadata files, parsing them in a pool of processes
+
+    Files found in `cache` are not parsed again, the others are parsed in
+    parallel and added to it.  Few files, or `max_workers` of 1, are read
+    in this process.
+
+    Args:
+        paths (list(str)): file paths
+        encoding (str, optional): file encoding. Defaults to "utf-8".
+        multival (bool, optional): returns tuple for multiple return values. Defaults to False.
+        cache (ReadCache, optional): reuse the parse of unchanged files. Defaults to None.
+        max_workers (int, optional): worker processes. Defaults to None, one per cpu.
+        mp_context (multiprocessing context, optional): how workers are started. Defaults to None.
+        on_error (function, optional): called as on_error(path, error) for files
+            that can not be read, which are then left out. Defaults to None, raise.
+
+    Returns:
+        dict: unserialized data by path, in the order of paths
+    """
+    results = {}
+    missing = []
+    stamps = {}
+    for path in paths:
+        data = None
+        if cache is not None:
+            try:
+                data = cache.get(path, encoding=encoding, multival=multival)
+                if data is None:
+                    stamps[path] = _stamp(path)
+            except OSError:
+                pass
+        results[path] = data
+        if data is None:
+            missing.append(path)
+
+    if missing:
+        tasks = [(path, encoding, multival) for path in missing]
+        outcomes = None
+        if max_workers != 1 and len(tasks) >= MIN_PARALLEL:
+            try:
+                workers = max_workers or os.cpu_count() or 1
+                chunksize = max(1, len(tasks) // (4 * workers))
+                with ProcessPoolExecutor(workers, mp_context=mp_context) as pool:
+                    outcomes = list(pool.map(_read_one, tasks, chunksize=chunksize))
+            except (OSError, NotImplementedError, BrokenProcessPool):
+                outcomes = None  # no usable worker processes here
+        if outcomes is None:
+            outcomes = map(_read_one, tasks)
+        for path, (data, error) in zip(missing, outcomes):
+            if error is not None:
+                if on_error is None:
+                    raise error
+                on_error(path, error)
+                del results[path]
+                continue
+            results[path] = data
+            if cache is not None:
+                try:
+                    cache.put(path, data, encoding=encoding, multival=multival, stamp=stamps.get(path))
+                except OSError:
+                    pass
+    return results
@@ -1,16 +1,120 @@
-import codecs
-from ..serializer.serialize import serialize
+import contextlib
+import hashlib
+import os
+import shutil
+import tempfile
+from ..serializer.serialize import serialize_to
 
+_READ_SIZE = 64 * 1024
 
-def write(path, data, encoding="utf-8", indent=None, prefix="return "):
+
+class _DigestSink:
+    """Text stream that only keeps the size and digest of what it is given."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.hash = hashlib.sha1()
+        self.size = 0
+
+    def write(self, fragment):
+        data = fragment.encode(self.encoding)
+        self.hash.update(data)
+        self.size = self.size + len(data)
+
+
+def _file_matches(path, size, digest):
+    """True if the file at path holds exactly size bytes with digest."""
+    try:
+        if os.stat(path).st_size != size:
+            return False
+        file_hash = hashlib.sha1()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(_READ_SIZE), b""):
+                file_hash.update(chunk)
+    except OSError:
+        return False
+    return file_hash.digest() == digest
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode="w", **kwargs):
+    """Open a temporary file that replaces path once the block succeeds.
+
+    The file is created next to path, so the final rename stays on the same
+    file system, and synced to disk before the rename.  If the block raises
+    the original file is left untouched.
+
+    Args:
+        path (str): file path to replace
+        mode (str, optional): "w" or "wb". Defaults to "w".
+        **kwargs: passed on to `open`, like encoding or newline
+
+    Yields:
+        file: the temporary file object
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, mode, **kwargs) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        try:
+            shutil.copymode(path, tmp_path)
+        except OSError:  # new file, or a file system without permissions
+            pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(directory)
+
+
+def _fsync_dir(directory):
+    """Make the rename durable, where directories can be synced at all."""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    try:
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write(path, data, encoding="utf-8", indent=None, prefix="return ", cache=None):
     """Write python data to luadata file
 
+    Data is serialized straight into the file, so memory use does not grow
+    with the size of `data`.  The file is replaced atomically, an interrupted
+    write never leaves it truncated, and it is not touched at all when it
+    already holds the same content.
+
     Args:
         path (str): file path to save data
         data (*): any variable that can be saved as luadata format
         encoding (str, optional): file encoding. Defaults to "utf-8".
         indent (str, optional): indent string. Defaults to None.
         prefix (str, optional): prefix string. Defaults to "return ".
+        cache (ReadCache, optional): cache to drop path from once it is written. Defaults to None.
+
+    Returns:
+        bool: False if the file was already up to date, True if it was written
     """
-    with codecs.open(path, "w", encoding) as file:
-        file.write(prefix + serialize(data, encoding=encoding, indent=indent))
+    sink = _DigestSink(encoding)
+    sink.write(prefix)
+    serialize_to(sink, data, encoding=encoding, indent=indent)
+    if _file_matches(path, sink.size, sink.hash.digest()):
+        return False
+
+    with atomic_open(path, "w", encoding=encoding, newline="") as file:
+        file.write(prefix)
+        serialize_to(file, data, encoding=encoding, indent=indent)
+    if cache is not None:
+        cache.invalidate(path)
+    return True
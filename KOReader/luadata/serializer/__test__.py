@@ -1,5 +1,6 @@
+import io
 import unittest
-from serialize import serialize
+from serialize import serialize, serialize_to
 from unserialize import unserialize
 
 
@@ -11,6 +12,17 @@ class TestSerializeMethods(unittest.TestCase):
         self.assertEqual(serialize("乗"), '"乗"')
         self.assertEqual(serialize("乗", "gbk"), '"乗\\"')
 
+    def test_string_escape(self):
+        self.assertEqual(serialize('a\\b"c\nd'), '"a\\\\b\\"c\\\nd"')
+        self.assertEqual(serialize("a\rb\x001"), '"a\\rb\\0001"')
+        self.assertEqual(serialize("\r\x00", "gbk"), '"\\r\\000"')
+
+    def test_key(self):
+        self.assertEqual(serialize({"a_1": 1}), "{a_1=1}")
+        self.assertEqual(serialize({"end": 1}), '{["end"]=1}')
+        self.assertEqual(serialize({"a\n": 1}), '{["a\\\n"]=1}')
+        self.assertEqual(serialize({"é": 1}), '{["é"]=1}')
+
     def test_bool(self):
         self.assertEqual(serialize(True), "true")
         self.assertEqual(serialize(False), "false")
@@ -61,6 +73,15 @@ class TestSerializeMethods(unittest.TestCase):
             '{\n  1,\n  2,\n  ["3"] = {\n    [3] = "3",\n  },\n}',
         )
 
+    def test_serialize_to(self):
+        data = {1: 1, 2: 2, "3": {3: "3"}, "4": ["乗"]}
+        text = io.StringIO()
+        serialize_to(text, data, indent="  ")
+        self.assertEqual(text.getvalue(), serialize(data, indent="  "))
+        binary = io.BytesIO()
+        serialize_to(binary, (1, data))
+        self.assertEqual(binary.getvalue(), serialize((1, data)).encode("utf-8"))
+
 
 class TestUnserializeMethods(unittest.TestCase):
     def test_string(self):
@@ -77,6 +98,13 @@ class TestUnserializeMethods(unittest.TestCase):
             unserialize('"乗"', "gbk")
         self.assertEqual(unserialize('"乗\\"', "gbk"), "乗")
 
+    def test_string_escape(self):
+        self.assertEqual(unserialize('"a\\\\b\\"c\\\nd"'), 'a\\b"c\nd')
+        self.assertEqual(unserialize('"\\r\\t\\0001\\65\\x41\\\'\\q"'), "\r\t\x001AA'\\q")
+        for value in ["a\rb\x001", '\\"\n\r\t', "乗\\"]:
+            self.assertEqual(unserialize(serialize(value)), value)
+            self.assertEqual(unserialize(serialize(value, "gbk"), "gbk"), value)
+
     def test_bool(self):
         with self.assertRaises(Exception):
             unserialize("True")
@@ -101,6 +129,21 @@ class TestUnserializeMethods(unittest.TestCase):
         self.assertEqual(unserialize("-100"), -100)
         self.assertEqual(unserialize("-100."), -100)
 
+    def test_binary(self):
+        self.assertEqual(unserialize(b'{1,"a"}'), [1, "a"])
+        self.assertEqual(unserialize(bytearray(b'{1,"a"}')), [1, "a"])
+        self.assertEqual(unserialize(memoryview(b'x{1,"\xe4\xb9\x97"}')[1:]), [1, "乗"])
+        with self.assertRaises(Exception):
+            unserialize(memoryview(b"{1,,}"))
+
+    def test_return(self):
+        self.assertEqual(unserialize("return {1}"), [1])
+        self.assertEqual(unserialize(b"-- c\nreturn 1, 2", multival=True), (1, 2))
+        with self.assertRaises(Exception):
+            unserialize("return return 1")
+        with self.assertRaises(Exception):
+            unserialize("{return}")
+
     def test_tuple(self):
         self.assertEqual(unserialize("1,2,3"), 1)
         self.assertEqual(unserialize("1", multival=True), tuple([1]))
@@ -161,6 +204,27 @@ class TestUnserializeMethods(unittest.TestCase):
             {1: 1, 2: 2, "3": {3: "3"}},
         )
 
+    def test_sparse_keys(self):
+        self.assertEqual(unserialize("{[2]=2,[1]=1,[3]=3}"), [1, 2, 3])
+        self.assertEqual(unserialize("{[3]=3,[1]=1}"), {1: 1, 3: 3})
+        self.assertEqual(unserialize('{[2]=2,"1",a=3}'), {1: "1", 2: 2, "a": 3})
+        self.assertEqual(
+            list(unserialize('{b=1,[2]=2,a=3,[0]=0,[1]=1}')),
+            [0, 1, 2, "b", "a"],
+        )
+
+    def test_duplicate_keys(self):
+        self.assertEqual(unserialize("{1,[1]=2}"), {1: 2})
+        self.assertEqual(unserialize("{[2]=1,[2]=2,[1]=1}"), {1: 1, 2: 2})
+
+    def test_error_position(self):
+        with self.assertRaisesRegex(Exception, "pos 3:\n.*\n     {3}\\^\n.*unexpected character"):
+            unserialize("{1 2}")
+        with self.assertRaisesRegex(Exception, "pos 5:.*\n.*\n.*\n.*missing close quote"):
+            unserialize('{"ab}')
+        with self.assertRaisesRegex(Exception, 'pos 3:.*\n.*\n.*\n.*"}" expected'):
+            unserialize("{1,")
+
     def test_comment(self):
         with self.assertRaises(Exception):
             self.assertEqual(unserialize("{ -- comment 1}"), [1])
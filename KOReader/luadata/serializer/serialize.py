@@ -1,56 +1,228 @@
+import codecs
+import functools
+import io
 import re
 
+# lua keywords can not be used as bare table keys
+_LUA_KEYWORDS = frozenset(
+    "and break do else elseif end false for function goto if in local nil not"
+    " or repeat return then true until while".split()
+)
 
-def __serialize(var, encoding, indent, level):
-    parts = []
-    var_type = type(var)
-    if var is None:
-        parts.append("nil")
-    elif isinstance(var, bool):
-        if var:
-            parts.append("true")
+# `\`, `"` and line breaks like lua's %q, `\r` and `\0` so they survive a
+# reload.  `\000` because a following digit would extend a shorter escape.
+_ESCAPES = str.maketrans(
+    {"\\": "\\\\", '"': '\\"', "\n": "\\\n", "\r": "\\r", "\0": "\\000"}
+)
+_NEEDS_ESCAPE = re.compile(r'[\\"\n\r\0]')
+_BYTE_ESCAPES = (
+    (b"\\", b"\\\\"),
+    (b'"', b'\\"'),
+    (b"\n", b"\\\n"),
+    (b"\r", b"\\r"),
+    (b"\0", b"\\000"),
+)
+
+
+def _is_identifier(key):
+    """True if key can be written as a bare `key = val`."""
+    return key.isascii() and key.isidentifier() and key not in _LUA_KEYWORDS
+
+
+@functools.lru_cache(maxsize=None)
+def _escaper(encoding):
+    """Return the functions escaping str values for the target encoding.
+
+    For utf-8 and single byte ascii compatible encodings the special bytes
+    only ever come from the special characters, so escaping works on str
+    directly and is skipped for the usual string without any.  Other
+    encodings (gbk, shift_jis...) can contain `\\` inside a multibyte
+    character and have to be escaped byte by byte.
+
+    Returns:
+        tuple(function, function): `search` telling if a str needs escaping,
+            or None if it always does, and `escape`.
+    """
+    name = codecs.lookup(encoding).name
+    if name in ("utf-8", "ascii") or name.startswith(("iso8859-", "cp125", "mac-")):
+        return _NEEDS_ESCAPE.search, lambda var: var.translate(_ESCAPES)
+
+    def escape(var):
+        data = var.encode(encoding)
+        for byte, escaped in _BYTE_ESCAPES:
+            data = data.replace(byte, escaped)
+        return data.decode(encoding)
+
+    return None, escape
+
+
+class _Pads(dict):
+    """Indent string by level."""
+
+    def __init__(self, indent):
+        self.indent = indent
+
+    def __missing__(self, level):
+        pad = self[level] = self.indent * level
+        return pad
+
+
+class _Frames(dict):
+    """`(head, separator, tail)` of an indented hash table by level."""
+
+    def __init__(self, pads):
+        self.pads = pads
+
+    def __missing__(self, level):
+        pad = self.pads[level + 1]
+        frame = self[level] = ("{\n" + pad, ",\n" + pad, ",\n" + self.pads[level] + "}")
+        return frame
+
+
+class _Serializer:
+    __slots__ = ("write", "search", "escape", "indent", "s_tab_equ", "pads", "frames", "key_heads")
+
+    def __init__(self, write, encoding, indent):
+        self.write = write
+        self.search, self.escape = _escaper(encoding)
+        self.indent = indent
+        self.s_tab_equ = "=" if indent is None else " = "
+        self.pads = _Pads(indent)
+        self.frames = _Frames(self.pads)
+        # memo of `key = ` for str keys, None for keys needing `["key"] = `
+        self.key_heads = {}
+
+    def value(self, var, level):
+        handler = _HANDLERS.get(type(var))
+        if handler is None:
+            handler = _handler_for(type(var))
+        handler(self, var, level)
+
+    def nil(self, var, level):
+        self.write("nil")
+
+    def bool(self, var, level):
+        self.write("true" if var else "false")
+
+    def number(self, var, level):
+        self.write(str(var))
+
+    def str(self, var, level):
+        if self.search is None or self.search(var):
+            var = self.escape(var)
+        self.write('"' + var + '"')
+
+    def unknown(self, var, level):
+        pass
+
+    def list(self, var, level):
+        if None in var:
+            # keys are written again after a nil value
+            self.table(enumerate(var, 1), len(var), level)
+            return
+        # otherwise a python list is always a pure lua list: no keys needed
+        write = self.write
+        if self.indent is None:
+            write("{")
+            first = True
+            for val in var:
+                if first:
+                    first = False
+                else:
+                    write(",")
+                self.value(val, level + 1)
+            write("}")
+        elif len(var) == 0:
+            write("{}")
+        else:
+            handlers = _HANDLERS
+            pad = self.pads[level + 1]
+            sep = ",\n" + pad
+            write("{\n" + pad)
+            first = True
+            for val in var:
+                if first:
+                    first = False
+                else:
+                    write(sep)
+                handler = handlers.get(type(val))
+                if handler is None:
+                    self.value(val, level + 1)
+                else:
+                    handler(self, val, level + 1)
+            write(",\n" + self.pads[level] + "}")
+
+    def dict(self, var, level):
+        for key in var:
+            break
+        if not var or isinstance(key, int):
+            self.table(var.items(), len(var), level)
+            return
+
+        # a non int first key makes it a hash table right away, every
+        # entry needs a key
+        write = self.write
+        search = self.search
+        escape = self.escape
+        key_heads = self.key_heads
+        if self.indent is None:
+            head = "{"
+            sep = ","
+            tail = "}"
         else:
-            parts.append("false")
-    elif isinstance(var, (int, float)):
-        parts.append(str(var))
-    elif isinstance(var, str):
-        parts.append('"')
-        parts.append(
-            var.encode(encoding)
-            .replace(b"\\", b"\\\\")
-            .replace(b'"', b'\\"')
-            .replace(b"\n", b"\\\n")
-            .decode(encoding)
-        )
-        parts.append('"')
-    elif isinstance(var, (list, dict)):
-        # calc lua table entries
-        entries = []
-        if isinstance(var, list):
-            for i in range(len(var)):
-                entries.append([i + 1, var[i]])
-        elif isinstance(var, dict):
-            for k in var:
-                entries.append([k, var[k]])
-
-        # build lua table parts
-        parts.append("{")
-        s_tab_equ = "="
-
-        # process indent
+            head, sep, tail = self.frames[level]
+        for key, val in var.items():
+            key_head = key_heads.get(key)
+            if key_head is None:
+                key_head = self.key_head(key)
+            if key_head is None:
+                write(head + "[")
+                self.value(key, level + 1)
+                head = "]"
+                key_head = self.s_tab_equ
+            # strings and numbers go out in one piece with their key
+            val_type = type(val)
+            if val_type is str:
+                if search is None or search(val):
+                    val = escape(val)
+                write(f'{head}{key_head}"{val}"')
+            elif val_type is int or val_type is float:
+                write(f"{head}{key_head}{val}")
+            else:
+                write(head + key_head)
+                self.value(val, level + 1)
+            head = sep
+        write(tail)
+
+    def key_head(self, key):
+        """Return `key = ` for identifier keys, None for any other key."""
+        key_heads = self.key_heads
+        if key in key_heads:
+            return key_heads[key]
+        head = None
+        if type(key) is str and _is_identifier(key):
+            head = key + self.s_tab_equ
+        if len(key_heads) < 4096:
+            key_heads[key] = head
+        return head
+
+    def table(self, entries, size, level):
+        write = self.write
+        value = self.value
+        indent = self.indent
+        s_tab_equ = self.s_tab_equ
+        write("{")
         if indent is not None:
-            s_tab_equ = " = "
-            if len(entries) != 0:
-                parts.append("\n")
+            if size != 0:
+                write("\n")
+            pad = self.pads[level + 1]
 
         # prepare for iterator
         nohash = True
         lastkey = None
         lastval = None
         hasval = False
-        for kv in entries:
-            key = kv[0]
-            val = kv[1]
+        for key, val in entries:
             # judge if this is a pure list table
             if nohash and (
                 not isinstance(key, int)
@@ -65,39 +237,95 @@ def __serialize(var, encoding, indent, level):
             # process to insert to table
             # insert indent
             if indent is not None:
-                parts.append(indent * (level + 1))
+                write(pad)
+            elif hasval:
+                write(",")
             # insert key
+            key_head = None
             if nohash:  # pure list: do not need a key
                 pass
-            elif isinstance(key, str) and re.match(
-                r"^[a-zA-Z_][a-zA-Z0-9_]*$", key
-            ):  # a = val
-                parts.append(key)
-                parts.append(s_tab_equ)
-            else:  # [10010] = val # [".start with or contains special char"] = val
-                parts.append("[")
-                parts.append(__serialize(key, encoding, indent, level + 1))
-                parts.append("]")
-                parts.append(s_tab_equ)
+            elif type(key) is str:  # a = val
+                key_head = self.key_head(key)
+            if key_head is not None:
+                write(key_head)
+            elif not nohash:  # [10010] = val # [".start with or contains special char"] = val
+                write("[")
+                value(key, level + 1)
+                write("]" + s_tab_equ)
             # insert value
-            parts.append(__serialize(val, encoding, indent, level + 1))
-            parts.append(",")
+            value(val, level + 1)
             if indent is not None:
-                parts.append("\n")
+                write(",\n")
             lastkey = key
             lastval = val
             hasval = True
 
-        # remove last `,` if no indent
-        if indent is None and hasval:
-            parts.pop()
-
         # insert `}` with indent
-        if indent is not None and len(entries) != 0:
-            parts.append(indent * level)
-        parts.append("}")
+        if indent is not None and size != 0:
+            write(self.pads[level])
+        write("}")
+
+
+_HANDLERS = {
+    type(None): _Serializer.nil,
+    bool: _Serializer.bool,
+    int: _Serializer.number,
+    float: _Serializer.number,
+    str: _Serializer.str,
+    list: _Serializer.list,
+    dict: _Serializer.dict,
+}
+
+
+def _handler_for(var_type):
+    """Find and remember the handler for subclasses of the supported types."""
+    for base in var_type.__mro__:
+        if base in _HANDLERS:
+            handler = _HANDLERS[base]
+            break
+    else:
+        handler = _Serializer.unknown
+    _HANDLERS[var_type] = handler
+    return handler
 
-    return "".join(parts)
+
+def serialize_to(fp, var, encoding="utf-8", indent=None, indent_level=0):
+    """Serialize variable as lua formatted data directly into a stream.
+
+    Fragments are written as they are produced, nothing bigger than a single
+    leaf value is built in memory.
+
+    Args:
+        fp (file): text stream, or binary stream which gets `encoding` encoded bytes
+        var (number, int, float, str, dict, list): variable you want to serialize
+        encoding (str, optional): target encoding, will affect string components escaping logic. Defaults to "utf-8".
+        indent (str, optional): indent string, such as '\\t'. Defaults to None, means no indention.
+        indent_level (int, optional): current indent level. Defaults to 0.
+    """
+    write = fp.write
+    if not isinstance(fp, io.TextIOBase) and (
+        isinstance(fp, (io.RawIOBase, io.BufferedIOBase))
+        or "b" in getattr(fp, "mode", "")
+    ):
+
+        def write(fragment):
+            fp.write(fragment.encode(encoding))
+
+    _serialize(write, var, encoding, indent, indent_level)
+
+
+def _serialize(write, var, encoding, indent, indent_level):
+    serializer = _Serializer(write, encoding, indent)
+    if isinstance(var, tuple):
+        spliter = ","
+        if indent is not None:
+            spliter = spliter + "\n" + indent * indent_level
+        for i, item in enumerate(var):
+            if i:
+                write(spliter)
+            serializer.value(item, indent_level)
+        return
+    serializer.value(var, indent_level)
 
 
 def serialize(var, encoding="utf-8", indent=None, indent_level=0):
@@ -112,12 +340,6 @@ def serialize(var, encoding="utf-8", indent=None, indent_level=0):
     Returns:
         string: serialized lua formatted data string
     """
-    if isinstance(var, tuple):
-        res = []
-        for item in var:
-            res.append(__serialize(item, encoding, indent, indent_level))
-        spliter = ","
-        if indent is not None:
-            spliter = spliter + "\n" + indent * indent_level
-        return spliter.join(res)
-    return __serialize(var, encoding, indent, indent_level)
+    parts = []
+    _serialize(parts.append, var, encoding, indent, indent_level)
+    return "".join(parts)
@@ -1,11 +1,119 @@
-import math
+import re
+
+
+class TableBuilder:
+    """Incrementally build the python value of a lua table constructor.
+
+    Entries are split like lua does: positive integer keys that continue the
+    sequence ``1..n`` go to a dense array part, everything else goes to a hash
+    part.  Hash entries are promoted to the array part as soon as the sequence
+    reaches them, so every append is amortized O(1).
+
+    The result of `to_table` is the same as sorting all entries by integer key
+    (other keys last, in insertion order) and taking a list when every entry
+    belongs to the sequence, a dict otherwise.
+    """
+
+    __slots__ = ("is_root", "array", "hash_int", "hash_other", "float_keys", "count")
+
+    def __init__(self, is_root=False):
+        self.is_root = is_root
+        self.array = []
+        self.hash_int = {}
+        self.hash_other = {}
+        self.float_keys = []
+        self.count = 0
+
+    @property
+    def lualen(self):
+        """Length of the sequence ``1..n``, the next positional key minus one."""
+        lualen = len(self.array)
+        # integral float keys sort after all int keys but still extend the
+        # sequence; they are rare enough to be rescanned.
+        for key in self.float_keys:
+            if key == lualen + 1:
+                lualen = lualen + 1
+        return lualen
+
+    def append(self, key, val):
+        self.count = self.count + 1
+        array = self.array
+        if type(key) is int:
+            size = len(array)
+            if key == size + 1:
+                array.append(val)
+                hash_int = self.hash_int
+                if hash_int:
+                    # promote entries the sequence just reached
+                    size = size + 2
+                    while size in hash_int:
+                        array.append(hash_int.pop(size))
+                        size = size + 1
+            elif 0 < key <= size:
+                array[key - 1] = val
+            else:
+                self.hash_int[key] = val
+        else:
+            if type(key) is float:
+                self.float_keys.append(key)
+            self.hash_other[key] = val
+
+    def to_table(self):
+        if self.count == self.lualen:
+            lst = self.array
+            for key in self.float_keys:
+                lst.append(self.hash_other[key])
+            return lst
+        dct = {}
+        int_keys = sorted(self.hash_int)
+        below = 0
+        while below < len(int_keys) and int_keys[below] < 1:
+            below = below + 1
+        for key in int_keys[:below]:
+            dct[key] = self.hash_int[key]
+        for i, val in enumerate(self.array):
+            dct[i + 1] = val
+        for key in int_keys[below:]:
+            dct[key] = self.hash_int[key]
+        for key, val in self.hash_other.items():
+            dct[key] = val
+        return dct
+
+
+# Every match skips leading whitespace and comments, then captures exactly one
+# token in the group telling its kind.  The final empty branch only matches at
+# the end of input, the single byte branch catches everything else.
+_TOKEN_RE = re.compile(
+    rb"[ \t\r\n]*(?:--(?:\[\[.*?(?:\]\]|\Z)|[^\n]*)[ \t\r\n]*)*"
+    rb"(?:"
+    rb'("[^"\\]*(?:\\.[^"\\]*)*"'
+    rb"|'[^'\\]*(?:\\.[^'\\]*)*')"
+    rb"|((?=[-0-9.])-?[0-9]*\.?[0-9]*)"
+    rb"|([A-Za-z_][A-Za-z0-9_]*)"
+    rb"|(\{)|(\})|(,)|(\[)|(\])|(=)"
+    rb"|(.)"
+    rb"|\Z)",
+    re.S,
+)
+_TOKEN_STRING = 1
+_TOKEN_NUMBER = 2
+_TOKEN_NAME = 3
+_TOKEN_OPEN = 4
+_TOKEN_CLOSE = 5
+_TOKEN_COMMA = 6
+_TOKEN_KEY_OPEN = 7
+_TOKEN_KEY_CLOSE = 8
+_TOKEN_ASSIGN = 9
+_TOKEN_OTHER = 10
 
 
 def unserialize(raw, encoding="utf-8", multival=False, verbose=False):
     """Unserialize stringified lua data to python data
 
     Args:
-        raw (str): raw lua data string
+        raw (str, bytes, bytearray, memoryview, mmap): raw lua data, a leading
+            ``return`` is skipped. Binary input is parsed in place, only the
+            strings that are returned get decoded.
         encoding (str, optional): string encoding. Defaults to "utf-8".
         multival (bool, optional): returns tuple for supporting multiple lua values likes "return 1, 2". Defaults to False.
         verbose (bool, optional): show more verbose debug information. Defaults to False.
@@ -16,349 +124,217 @@ def unserialize(raw, encoding="utf-8", multival=False, verbose=False):
     Returns:
         tuple([*]): unserialized data
     """
-    sbins = raw.encode(encoding)
-    root = {"entries": [], "lualen": 0, "is_root": True}
+    if isinstance(raw, str):
+        sbins = raw.encode(encoding)
+    else:
+        sbins = raw
+    root = TableBuilder(is_root=True)
     node = root
     stack = []
     state = "SEEK_CHILD"
-    pos = 0
     slen = len(sbins)
-    byte_quoting_char = None
     key = None
-    escaping = False
-    comment = None
-    component_name = None
     errmsg = None
+    chunk_start = True
 
-    def sorter(kv):
-        if isinstance(kv[0], int):
-            return kv[0]
-        return math.inf
-
-    def node_entries_append(node, key, val):
-        node["entries"].append([key, val])
-        node["entries"].sort(key=sorter)
-        lualen = 0
-        for kv in node["entries"]:
-            if kv[0] == lualen + 1:
-                lualen = lualen + 1
-        node["lualen"] = lualen
-
-    def node_to_table(node):
-        if len(node["entries"]) == node["lualen"]:
-            lst = []
-            for kv in node["entries"]:
-                lst.append(kv[1])
-            return lst
-        else:
-            dct = {}
-            for kv in node["entries"]:
-                dct[kv[0]] = kv[1]
-            return dct
-
-    while pos <= slen:
-        byte_current = None
-        byte_current_is_space = False
-        if pos < slen:
-            byte_current = sbins[pos : pos + 1]
-            byte_current_is_space = (
-                byte_current == b" "
-                or byte_current == b"\r"
-                or byte_current == b"\n"
-                or byte_current == b"\t"
-            )
+    for match in _TOKEN_RE.finditer(sbins):
+        kind = match.lastindex
+        if kind is not None and kind <= _TOKEN_NAME:
+            token = match.group(kind)
         if verbose:
-            print("[step] pos", pos, byte_current, state, comment, key, node)
-
-        if comment == "MULTILINE":
-            if byte_current == b"]" and sbins[pos : pos + 2] == b"]]":
-                comment = None
-                pos = pos + 1
-        elif comment == "INLINE":
-            if byte_current == b"\n":
-                comment = None
-        elif state == "SEEK_CHILD":
-            if byte_current is None:
+            print("[step] pos", match.start(kind or 0), match.group(kind or 0), state, key)
+
+        if state == "SEEK_CHILD":
+            if kind is None:
                 break
-            if byte_current == b"-" and sbins[pos : pos + 4] == b"--[[":
-                comment = "MULTILINE"
-                pos = pos + 3
-            elif byte_current == b"-" and sbins[pos : pos + 2] == b"--":
-                comment = "INLINE"
-                pos = pos + 1
-            elif not node["is_root"] and (
-                (byte_current >= b"A" and byte_current <= b"Z")
-                or (byte_current >= b"a" and byte_current <= b"z")
-                or byte_current == b"_"
-            ):
-                state = "KEY_SIMPLE"
-                pos1 = pos
-            elif not node["is_root"] and byte_current == b"[":
+            if chunk_start:
+                chunk_start = False
+                if kind == _TOKEN_NAME and token == b"return":
+                    continue
+            if kind == _TOKEN_CLOSE:
+                state = "VALUE_END"
+            elif not node.is_root and kind == _TOKEN_NAME:
+                key = token.decode(encoding)
+                state = "KEY_SIMPLE_END"
+                continue
+            elif not node.is_root and kind == _TOKEN_KEY_OPEN:
                 state = "KEY_EXPRESSION_OPEN"
-            elif byte_current == b"}":
-                if len(stack) == 0:
-                    errmsg = (
-                        "unexpected table closing, no matching opening braces found."
-                    )
-                    break
-                prev_env = stack.pop()
-                if prev_env["state"] == "KEY_EXPRESSION_OPEN":
-                    key = node_to_table(node)
-                    state = "KEY_END"
-                elif prev_env["state"] == "VALUE":
-                    node_entries_append(
-                        prev_env["node"],
-                        prev_env["key"],
-                        node_to_table(node),
-                    )
-                    state = "VALUE_END"
-                    key = None
-                node = prev_env["node"]
-            elif not byte_current_is_space:
-                key = node["lualen"] + 1
+                continue
+            else:
+                key = node.lualen + 1
                 state = "VALUE"
-                pos = pos - 1
-        elif state == "VALUE":
-            if byte_current is None:
-                errmsg = "unexpected empty value."
-                break
-            if byte_current == b"-" and sbins[pos : pos + 4] == b"--[[":
-                comment = "MULTILINE"
-                pos = pos + 3
-            elif byte_current == b"-" and sbins[pos : pos + 2] == b"--":
-                comment = "INLINE"
-                pos = pos + 1
-            elif byte_current == b'"' or byte_current == b"'":
-                state = "TEXT"
-                component_name = "VALUE"
-                pos1 = pos + 1
-                byte_quoting_char = byte_current
-            elif byte_current == b"-" or (
-                byte_current >= b"0" and byte_current <= b"9"
-            ):
-                state = "INT"
-                component_name = "VALUE"
-                pos1 = pos
-            elif byte_current == b".":
-                state = "FLOAT"
-                component_name = "VALUE"
-                pos1 = pos
-            elif byte_current == b"t" and sbins[pos : pos + 4] == b"true":
-                node_entries_append(node, key, True)
-                state = "VALUE_END"
+
+        if state == "KEY_SIMPLE_END":
+            if kind == _TOKEN_ASSIGN:
+                state = "VALUE"
+                continue
+            if kind == _TOKEN_COMMA or kind == _TOKEN_CLOSE:
+                if key != "true" and key != "false":
+                    errmsg = "invalied table simple key character."
+                    break
+                node.append(node.lualen + 1, key == "true")
                 key = None
-                pos = pos + 3
-            elif byte_current == b"f" and sbins[pos : pos + 5] == b"false":
-                node_entries_append(node, key, False)
                 state = "VALUE_END"
-                key = None
-                pos = pos + 4
-            elif byte_current == b"{":
-                stack.append({"node": node, "state": state, "key": key})
-                state = "SEEK_CHILD"
-                node = {"entries": [], "lualen": 0, "is_root": False}
-        elif state == "TEXT":
-            if byte_current is None:
-                errmsg = "unexpected string ending: missing close quote."
+            else:
+                errmsg = 'unexpected character, "=" expected.'
                 break
-            if escaping:
-                escaping = False
-            elif byte_current == b"\\":
-                escaping = True
-            elif byte_current == byte_quoting_char:
-                data = (
-                    sbins[pos1:pos]
-                    .replace(b"\\\n", b"\n")
-                    .replace(b'\\"', b'"')
-                    .replace(b"\\\\", b"\\")
-                    .decode(encoding)
-                )
-                if component_name == "KEY":
-                    key = data
-                    state = "KEY_EXPRESSION_FINISH"
-                elif component_name == "VALUE":
-                    node_entries_append(node, key, data)
-                    state = "VALUE_END"
-                    key = None
-                data = None
-        elif state == "INT":
-            if byte_current == b".":
-                state = "FLOAT"
-            elif byte_current is None or byte_current < b"0" or byte_current > b"9":
-                data = int(sbins[pos1:pos].decode(encoding))
-                if component_name == "KEY":
-                    key = data
-                    state = "KEY_EXPRESSION_FINISH"
-                    pos = pos - 1
-                elif component_name == "VALUE":
-                    node_entries_append(node, key, data)
-                    state = "VALUE_END"
-                    key = None
-                    pos = pos - 1
-                data = None
-        elif state == "FLOAT":
-            if byte_current is None or byte_current < b"0" or byte_current > b"9":
-                if pos == pos1 + 1 and sbins[pos1:pos] == b".":
-                    errmsg = "unexpected dot."
+
+        if state == "VALUE":
+            if kind == _TOKEN_STRING:
+                node.append(key, _unquote(token, encoding))
+            elif kind == _TOKEN_NUMBER:
+                data = _number(token)
+                if data is None:
+                    errmsg = _number_error(token)
                     break
-                else:
-                    data = float(sbins[pos1:pos].decode(encoding))
-                    if component_name == "KEY":
-                        key = data
-                        state = "KEY_EXPRESSION_FINISH"
-                        pos = pos - 1
-                    elif component_name == "VALUE":
-                        node_entries_append(node, key, data)
-                        state = "VALUE_END"
-                        key = None
-                        pos = pos - 1
-                    data = None
-        elif state == "VALUE_END":
-            if byte_current is None:
-                pass
-            elif byte_current == b"-" and sbins[pos : pos + 4] == b"--[[":
-                comment = "MULTILINE"
-                pos = pos + 3
-            elif byte_current == b"-" and sbins[pos : pos + 2] == b"--":
-                comment = "INLINE"
-                pos = pos + 1
-            elif byte_current == b",":
-                state = "SEEK_CHILD"
-            elif byte_current == b"}":
+                node.append(key, data)
+            elif kind == _TOKEN_NAME and token == b"true":
+                node.append(key, True)
+            elif kind == _TOKEN_NAME and token == b"false":
+                node.append(key, False)
+            elif kind == _TOKEN_OPEN:
+                stack.append((node, key))
+                node = TableBuilder()
+                key = None
                 state = "SEEK_CHILD"
-                pos = pos - 1
-            elif not byte_current_is_space:
+                continue
+            elif kind is None:
+                errmsg = "unexpected empty value."
+                break
+            else:
                 errmsg = "unexpected character."
                 break
-        elif state == "KEY_EXPRESSION_OPEN":
-            if byte_current is None:
-                errmsg = "key expression expected."
+            key = None
+            state = "VALUE_END"
+            continue
+
+        if state == "VALUE_END":
+            if kind is None:
                 break
-            if byte_current == b"-" and sbins[pos : pos + 4] == b"--[[":
-                comment = "MULTILINE"
-                pos = pos + 3
-            elif byte_current == b"-" and sbins[pos : pos + 2] == b"--":
-                comment = "INLINE"
-                pos = pos + 1
-            elif byte_current == b'"' or byte_current == b"'":
-                state = "TEXT"
-                component_name = "KEY"
-                pos1 = pos + 1
-                byte_quoting_char = byte_current
-            elif byte_current == b"-" or (
-                byte_current >= b"0" and byte_current <= b"9"
-            ):
-                state = "INT"
-                component_name = "KEY"
-                pos1 = pos
-            elif byte_current == b".":
-                state = "FLOAT"
-                component_name = "KEY"
-                pos1 = pos
-            elif byte_current == b"t" and sbins[pos : pos + 4] == b"true":
-                errmsg = "python do not support bool as dict key."
+            if kind == _TOKEN_COMMA:
+                state = "SEEK_CHILD"
+            elif kind == _TOKEN_CLOSE:
+                if len(stack) == 0:
+                    errmsg = (
+                        "unexpected table closing, no matching opening braces found."
+                    )
+                    break
+                parent, key = stack.pop()
+                parent.append(key, node.to_table())
+                node = parent
+                key = None
+            else:
+                errmsg = "unexpected character."
                 break
-                key = True
+        elif state == "KEY_EXPRESSION_OPEN":
+            if kind == _TOKEN_STRING:
+                key = _unquote(token, encoding)
                 state = "KEY_EXPRESSION_FINISH"
-                pos = pos + 3
-            elif byte_current == b"f" and sbins[pos : pos + 5] == b"false":
-                errmsg = "python do not support bool variable as dict key."
-                break
-                key = False
+            elif kind == _TOKEN_NUMBER:
+                key = _number(token)
+                if key is None:
+                    errmsg = _number_error(token)
+                    break
                 state = "KEY_EXPRESSION_FINISH"
-                pos = pos + 4
-            elif byte_current == b"{":
+            elif kind == _TOKEN_NAME and token in (b"true", b"false"):
+                errmsg = "python do not support bool as dict key."
+                break
+            elif kind == _TOKEN_OPEN:
                 errmsg = "python do not support lua table variable as dict key."
                 break
-                state = "SEEK_CHILD"
-                stack.push({"node": node, "state": state, "key": key})
-                node = {"entries": [], "lualen": 0}
+            else:
+                errmsg = "key expression expected."
+                break
         elif state == "KEY_EXPRESSION_FINISH":
-            if byte_current is None:
+            if kind is None:
                 errmsg = 'unexpected end of table key expression, "]" expected.'
                 break
-            if byte_current == b"-" and sbins[pos : pos + 4] == b"--[[":
-                comment = "MULTILINE"
-                pos = pos + 3
-            elif byte_current == b"-" and sbins[pos : pos + 2] == b"--":
-                comment = "INLINE"
-                pos = pos + 1
-            elif byte_current == b"]":
+            if kind == _TOKEN_KEY_CLOSE:
                 state = "KEY_EXPRESSION_CLOSE"
-            elif not byte_current_is_space:
+            else:
                 errmsg = 'unexpected character, "]" expected.'
                 break
         elif state == "KEY_EXPRESSION_CLOSE":
-            if byte_current == b"=":
+            if kind == _TOKEN_ASSIGN:
                 state = "VALUE"
-            elif byte_current == b"-" and sbins[pos : pos + 4] == b"--[[":
-                comment = "MULTILINE"
-                pos = pos + 3
-            elif byte_current == b"-" and sbins[pos : pos + 2] == b"--":
-                comment = "INLINE"
-                pos = pos + 1
-            elif not byte_current_is_space:
+            else:
                 errmsg = 'unexpected character, "=" expected.'
                 break
-        elif state == "KEY_SIMPLE":
-            if not (
-                (byte_current >= b"A" and byte_current <= b"Z")
-                or (byte_current >= b"a" and byte_current <= b"z")
-                or (byte_current >= b"0" and byte_current <= b"9")
-                or byte_current == b"_"
-            ):
-                key = sbins[pos1:pos].decode(encoding)
-                state = "KEY_SIMPLE_END"
-                pos = pos - 1
-        elif state == "KEY_SIMPLE_END":
-            if byte_current_is_space:
-                pass
-            elif byte_current == b"-" and sbins[pos : pos + 4] == b"--[[":
-                comment = "MULTILINE"
-                pos = pos + 3
-            elif byte_current == b"-" and sbins[pos : pos + 2] == b"--":
-                comment = "INLINE"
-                pos = pos + 1
-            elif byte_current == b"=":
-                state = "VALUE"
-            elif byte_current == b"," or byte_current == b"}":
-                if key == "true":
-                    node_entries_append(node, node["lualen"] + 1, True)
-                    state = "VALUE_END"
-                    key = None
-                    pos = pos - 1
-                elif key == "false":
-                    node_entries_append(node, node["lualen"] + 1, False)
-                    state = "VALUE_END"
-                    key = None
-                    pos = pos - 1
-                else:
-                    key = None
-                    errmsg = "invalied table simple key character."
-                    break
-        pos += 1
-        if verbose:
-            print("          ", pos, "    ", state, comment, key, node)
 
     # check if there is any errors
     if errmsg is None and len(stack) != 0:
         errmsg = 'unexpected end of table, "}" expected.'
-    if errmsg is None and root["lualen"] == 0:
+    if errmsg is None and root.lualen == 0:
         errmsg = "nothing can be unserialized from input string."
     if errmsg is not None:
-        pos = min(pos, slen)
+        if kind is None:
+            pos = slen
+        elif kind == _TOKEN_OTHER and match.group(kind) in (b'"', b"'"):
+            # an unterminated string is only seen as a stray quote
+            errmsg = "unexpected string ending: missing close quote."
+            pos = slen
+        else:
+            pos = match.start(kind)
         start_pos = max(0, pos - 4)
         end_pos = min(pos + 10, slen)
-        err_parts = sbins[start_pos:end_pos].decode(encoding)
+        err_parts = bytes(sbins[start_pos:end_pos]).decode(encoding, "replace")
         err_indent = " " * (pos - start_pos)
         raise Exception(
             "Unserialize luadata failed on pos %d:\n    %s\n    %s^\n    %s"
             % (pos, err_parts, err_indent, errmsg)
         )
 
-    res = []
-    for kv in root["entries"]:
-        res.append(kv[1])
+    res = root.to_table()
     if multival:
         return tuple(res)
     return res[0]
+
+
+_ESCAPE_RE = re.compile(rb"\\(?:([0-9]{1,3})|x([0-9A-Fa-f]{2})|(.))", re.S)
+_SIMPLE_ESCAPES = {
+    b"a": b"\a",
+    b"b": b"\b",
+    b"f": b"\f",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"v": b"\v",
+    b"\\": b"\\",
+    b'"': b'"',
+    b"'": b"'",
+    b"\n": b"\n",
+}
+
+
+def _unescape(match):
+    decimal, hexadecimal, char = match.groups()
+    if decimal is not None:
+        return bytes((int(decimal) & 0xFF,))
+    if hexadecimal is not None:
+        return bytes((int(hexadecimal, 16),))
+    # unknown escapes are kept as they are
+    return _SIMPLE_ESCAPES.get(char, b"\\" + char)
+
+
+def _unquote(token, encoding):
+    data = token[1:-1]
+    if b"\\" in data:
+        data = _ESCAPE_RE.sub(_unescape, data)
+    return data.decode(encoding)
+
+
+def _number(token):
+    """Convert a number token, None if it is a lone dot or sign."""
+    if b"." in token:
+        if token in (b".", b"-."):
+            return None
+        return float(token)
+    if token == b"-":
+        return None
+    return int(token)
+
+
+def _number_error(token):
+    if b"." in token:
+        return "unexpected dot."
+    return "unexpected character."
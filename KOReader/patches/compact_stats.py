@@ -0,0 +1,32 @@
+"""
+Write a compact copy of a KOReader statistics.sqlite3: duplicate books
+from title churn merged, orphan and duplicate page stats dropped,
+indexes rebuilt and the file vacuumed.  See KOReader/stats/compact.py.
+The original is only read.
+
+    python compact_stats.py statistics.sqlite3 statistics-compact.sqlite3
+"""
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stats.compact import compact
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dedupe and compact KOReader statistics.")
+    parser.add_argument('db', help="statistics.sqlite3 to compact")
+    parser.add_argument('dest', help="new file to write the compacted copy to")
+    args = parser.parse_args(argv)
+
+    result = compact(args.db, args.dest)
+    before, after = result['before'], result['after']
+    print("%-16s %12s %12s"%('', 'before', 'after'))
+    for name in before:
+        print("%-16s %12d %12d"%(name, before[name], after.get(name, 0)))
+    for name, count in result['changes'].items():
+        print("%s: %d"%(name, count))
+
+if __name__ == '__main__':
+    main()
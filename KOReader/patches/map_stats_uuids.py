@@ -0,0 +1,46 @@
+"""
+Fill the uuid table 2-statistics-with-uuid-key.lua expects in
+statistics.sqlite3, creating it if needed, see
+KOReader/stats/uuids.py.
+
+Each statistics book is matched to a calibre book by partial md5 (for
+the books on the device, given --device) or by normalized title and
+authors (from calibre's device book list and/or --library).  Books
+already in the uuid table are left alone.
+
+    python map_stats_uuids.py statistics.sqlite3 --library ~/Calibre\ Library --device /media/KOBOeReader
+"""
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stats.uuids import Matcher, device_books, library_books, populate
+from stats.migrate import connect
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Map KOReader statistics books to calibre uuids.")
+    parser.add_argument('db', help="statistics.sqlite3 to update")
+    parser.add_argument('--library', help="calibre library folder, with metadata.db")
+    parser.add_argument('--device', help="device root, with calibre's metadata.calibre")
+    args = parser.parse_args(argv)
+    if not (args.library or args.device):
+        parser.error("give --library and/or --device")
+
+    matcher = Matcher()
+    if args.device:
+        for uuid, title, authors, md5 in device_books(args.device):
+            matcher.add(uuid, title, authors, md5)
+    if args.library:
+        for uuid, title, authors in library_books(os.path.join(args.library, 'metadata.db')):
+            matcher.add(uuid, title, authors)
+
+    db = connect(args.db)
+    try:
+        print("books mapped: %d"%populate(db, matcher))
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+"""Tools for KOReader's statistics.sqlite3, usable with or without calibre."""
+
+from .digest import partial_md5
+from .migrate import connect, migrate, normalize_title
@@ -0,0 +1,177 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stats.compact import dedupe
+from stats.migrate import connect, dry_run, migrate, plan
+
+# KOReader's statistics.sqlite3, as plugins/statistics.koplugin creates it,
+# and the 2-statistics-with-uuid-key.lua patch's uuid table.
+SCHEMA = (
+    """CREATE TABLE book (id integer PRIMARY KEY autoincrement, title text, authors text,
+       notes integer, last_open integer, highlights integer, pages integer, series text,
+       language text, md5 text, total_read_time integer, total_read_pages integer)""",
+    """CREATE TABLE page_stat_data (id_book integer, page integer NOT NULL DEFAULT 0,
+       start_time integer NOT NULL DEFAULT 0, duration integer NOT NULL DEFAULT 0,
+       total_pages integer NOT NULL DEFAULT 0, UNIQUE (id_book, page, start_time),
+       FOREIGN KEY(id_book) REFERENCES book(id))""",
+    "CREATE INDEX page_stat_data_start_time ON page_stat_data (start_time)",
+    "CREATE UNIQUE INDEX book_title_authors_md5 ON book(title, authors, md5)",
+    """CREATE TABLE uuid (uuid TEXT PRIMARY KEY, id_book INTEGER, UNIQUE (id_book),
+       FOREIGN KEY(id_book) REFERENCES book(id))""",
+)
+
+# id, title, authors, notes, last_open, highlights, total_read_time, total_read_pages
+BOOKS = (
+    (1, "The Book", "A", 1, 10, 2, 100, 10),
+    (2, "000 The Book (12,345)", "A", 2, 30, 3, 50, 5),
+    (3, "The Book (9)", "A", 0, 20, 0, 25, 2),
+    (4, "The Book", "B", 0, 40, 0, 7, 1),
+    (5, "Other", "A", 0, 50, 0, 0, 0),
+)
+
+# id_book, page, start_time, duration
+PAGE_STATS = (
+    (1, 1, 1000, 10),
+    (1, 2, 1010, 10),
+    (2, 1, 1000, 30),
+    (3, 5, 2000, 5),
+    (4, 1, 1000, 7),
+)
+
+
+class StatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "statistics.sqlite3")
+
+    def make_db(self, books=BOOKS, page_stats=PAGE_STATS, uuids=(), schema=SCHEMA):
+        db = connect(self.path)
+        for sql in schema:
+            db.execute(sql)
+        db.executemany(
+            """insert into book (id, title, authors, notes, last_open, highlights,
+               total_read_time, total_read_pages, md5) values (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            [book + ("md5-%d" % book[0],) for book in books],
+        )
+        db.executemany(
+            "insert into page_stat_data (id_book, page, start_time, duration) values (?, ?, ?, ?)",
+            page_stats,
+        )
+        if uuids:
+            db.executemany("insert into uuid (uuid, id_book) values (?, ?)", uuids)
+        self.addCleanup(db.close)
+        return db
+
+    def rows(self, db, sql):
+        return db.execute(sql).fetchall()
+
+
+class TestMigrateMethods(StatsTestCase):
+    def test_plan(self):
+        db = self.make_db()
+        plan(db)
+        self.assertEqual(
+            self.rows(db, "select id, norm, keeper from merge order by id"),
+            [(1, "The Book", 2), (2, "The Book", 2), (3, "The Book", 2), (4, "The Book", 4), (5, "Other", 5)],
+        )
+        self.assertEqual(self.rows(db, "select id, keeper from merged order by id"), [(1, 2), (3, 2)])
+
+    def test_migrate(self):
+        db = self.make_db(uuids=[("calibre:x", 1)])
+        counts = migrate(db)
+        self.assertEqual(
+            counts,
+            {"books merged": 2, "page stats moved": 2, "page stats dropped": 1, "titles normalized": 1},
+        )
+        self.assertEqual(
+            self.rows(db, "select id, title, notes, highlights, total_read_time, total_read_pages from book order by id"),
+            [(2, "The Book", 3, 5, 175, 17), (4, "The Book", 0, 0, 7, 1), (5, "Other", 0, 0, 0, 0)],
+        )
+        # book 1's page 1 at 1000 is already on book 2, it goes with book 1
+        self.assertEqual(
+            self.rows(db, "select id_book, page, start_time, duration from page_stat_data order by id_book, page"),
+            [(2, 1, 1000, 30), (2, 2, 1010, 10), (2, 5, 2000, 5), (4, 1, 1000, 7)],
+        )
+        self.assertEqual(self.rows(db, "select uuid, id_book from uuid"), [("calibre:x", 2)])
+        self.assertEqual(self.rows(db, "select name from sqlite_temp_master"), [])
+
+    def test_migrate_again(self):
+        db = self.make_db(uuids=[("calibre:x", 1)])
+        migrate(db)
+        books = self.rows(db, "select * from book order by id")
+        page_stats = self.rows(db, "select * from page_stat_data order by id_book, page")
+        self.assertEqual(
+            migrate(db),
+            {"books merged": 0, "page stats moved": 0, "page stats dropped": 0, "titles normalized": 0},
+        )
+        self.assertEqual(self.rows(db, "select * from book order by id"), books)
+        self.assertEqual(self.rows(db, "select * from page_stat_data order by id_book, page"), page_stats)
+
+    def test_no_uuid_table(self):
+        db = self.make_db(schema=SCHEMA[:-1])
+        self.assertEqual(migrate(db)["books merged"], 2)
+
+    def test_uuid_split(self):
+        # 1 and 2 are different calibre books, 3 and 4 aren't mapped
+        books = BOOKS[:3] + ((6, "The Book (1)", "A", 0, 25, 0, 1, 1),)
+        db = self.make_db(books=books, page_stats=(), uuids=[("calibre:a", 1), ("calibre:b", 2)])
+        plan(db)
+        self.assertEqual(self.rows(db, "select id, keeper from merged order by id"), [(3, 6)])
+        migrate(db)
+        self.assertEqual(self.rows(db, "select id from book order by id"), [(1,), (2,), (6,)])
+        self.assertEqual(self.rows(db, "select uuid, id_book from uuid order by uuid"), [("calibre:a", 1), ("calibre:b", 2)])
+
+    def test_one_uuid(self):
+        # the unmapped books still merge with the only mapped one
+        db = self.make_db(uuids=[("calibre:a", 3)])
+        migrate(db)
+        self.assertEqual(self.rows(db, "select id from book where authors = 'A' order by id"), [(2,), (5,)])
+        self.assertEqual(self.rows(db, "select uuid, id_book from uuid"), [("calibre:a", 2)])
+
+
+class TestDedupeMethods(StatsTestCase):
+    def test_dedupe(self):
+        # older statistics.sqlite3 have no unique index on page stats
+        schema = (SCHEMA[0], SCHEMA[1].replace("UNIQUE (id_book, page, start_time),", "")) + SCHEMA[2:]
+        page_stats = PAGE_STATS + ((4, 1, 1000, 8), (4, 2, 1100, 9), (99, 1, 1000, 5))
+        db = self.make_db(page_stats=page_stats, schema=schema)
+        counts = dedupe(db)
+        self.assertEqual(counts["books merged"], 2)
+        self.assertEqual(counts["orphan page stats dropped"], 1)
+        # without the index migrate moves book 1's page 1 at 1000 onto book 2
+        # as well, dedupe keeps the first of each
+        self.assertEqual(counts["page stats dropped"], 0)
+        self.assertEqual(counts["duplicate page stats dropped"], 2)
+        self.assertEqual(
+            self.rows(db, "select id_book, page, start_time, duration from page_stat_data order by id_book, page"),
+            [(2, 1, 1000, 10), (2, 2, 1010, 10), (2, 5, 2000, 5), (4, 1, 1000, 7), (4, 2, 1100, 9)],
+        )
+        self.assertEqual(self.rows(db, "select count(*) from page_stat_data where id_book not in (select id from book)"), [(0,)])
+
+
+class TestDryRunMethods(StatsTestCase):
+    def test_dry_run(self):
+        db = self.make_db(uuids=[("calibre:x", 1)])
+        books = self.rows(db, "select * from book order by id")
+        report = dry_run(self.path)
+        self.assertEqual(
+            report["counts"],
+            {"books merged": 2, "page stats moved": 2, "page stats dropped": 1, "titles normalized": 1},
+        )
+        self.assertEqual(report["merged"], {2: [1, 3]})
+        self.assertEqual(
+            report["books"],
+            {2: {"title": ["000 The Book (12,345)", "The Book"], "total_read_time": [50, 175], "page_stat_seconds": [30, 45]}},
+        )
+        # the file is left alone
+        self.assertEqual(self.rows(db, "select * from book order by id"), books)
+        self.assertEqual(self.rows(db, "select uuid, id_book from uuid"), [("calibre:x", 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""Write a deduplicated, compacted copy of a statistics.sqlite3."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+from .migrate import memory_copy, migrate
+
+## tables counted before and after.
+TABLES = ('book', 'page_stat_data', 'uuid')
+
+def row_counts(db):
+    counts = {}
+    for table in TABLES:
+        if db.execute("select 1 from sqlite_master where type='table' and name=?", (table,)).fetchall():
+            counts[table] = db.execute('select count(*) from %s'%table).fetchall()[0][0]
+    return counts
+
+def dedupe(db):
+    '''
+    Merge duplicate books (see migrate), then drop page stats of
+    books that no longer exist and repeated (id_book, page,
+    start_time) rows, keeping the first, and rebuild the indexes.
+    Returns counts of what was done.
+    '''
+    counts = migrate(db)
+    with db:
+        before = db.totalchanges()
+        db.execute('''delete from page_stat_data
+                      where id_book not in (select id from book)''')
+        counts['orphan page stats dropped'] = db.totalchanges() - before
+        before = db.totalchanges()
+        db.execute('''delete from page_stat_data
+                      where rowid not in (select min(rowid) from page_stat_data
+                                          group by id_book, page, start_time)''')
+        counts['duplicate page stats dropped'] = db.totalchanges() - before
+        db.execute('reindex')
+    return counts
+
+def compact(path, dest_path):
+    '''
+    Dedupe a copy of the statistics.sqlite3 at path in memory and
+    write it compacted to dest_path with VACUUM INTO.  path is only
+    read.  Returns {'before': ..., 'after': ..., 'changes': ...},
+    row counts by table and file size in 'bytes'.
+    '''
+    if os.path.exists(dest_path):
+        raise ValueError("'%s' already exists"%dest_path)
+    db = memory_copy(path)
+    try:
+        before = row_counts(db)
+        before['bytes'] = os.path.getsize(path)
+        changes = dedupe(db)
+        db.execute('vacuum into ?', (dest_path,))
+        after = row_counts(db)
+        after['bytes'] = os.path.getsize(dest_path)
+    finally:
+        db.close()
+    logger.info("statistics compacted from %s to %s"%(before, after))
+    return {'before': before, 'after': after, 'changes': changes}
@@ -0,0 +1,26 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""KOReader's partial MD5 book digest."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import hashlib
+
+SAMPLE_SIZE = 1024
+
+def partial_md5(path):
+    '''
+    KOReader's util.partialMD5: md5 of 1KB samples at 0 and at
+    1KB << 2*i for i 0..10, up to the end of the file.
+    '''
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for offset in [0] + [ SAMPLE_SIZE << (2*i) for i in range(11) ]:
+            f.seek(offset)
+            sample = f.read(SAMPLE_SIZE)
+            if not sample:
+                break
+            h.update(sample)
+    return h.hexdigest()
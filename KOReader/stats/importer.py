@@ -0,0 +1,83 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""Reading totals per calibre book from KOReader's page statistics."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import json
+
+import logging
+logger = logging.getLogger(__name__)
+
+from .migrate import has_table
+from .uuids import UUID_PREFIX
+
+## a page read starting more than this many seconds after the
+## previous one ended starts a new reading session.
+SESSION_GAP = 30*60
+
+## what the totals are, in order.
+SECONDS  = 0
+PAGES    = 1
+SESSIONS = 2
+
+def book_states(db):
+    '''
+    {calibre uuid: [id_book, total_read_time, total_read_pages]} of
+    the books in the uuid table.  A book remapped, merged by a
+    migration or closed in KOReader since shows up as changed.
+    '''
+    if not has_table(db, 'uuid'):
+        return {}
+    return { uuid[len(UUID_PREFIX):]: [id_book, total_read_time, total_read_pages]
+             for uuid, id_book, total_read_time, total_read_pages in db.execute(
+                 '''select u.uuid, u.id_book, b.total_read_time, b.total_read_pages
+                    from uuid u left join book b on b.id = u.id_book''')
+             if uuid and uuid.startswith(UUID_PREFIX) }
+
+def read_since(db, since):
+    '''
+    Calibre uuids of the books with page stats started after since,
+    and the latest start_time of them, the since for the next call.
+    Page stats of books without a uuid row don't move since, once
+    mapped those books are new in book_states anyway.
+    '''
+    uuids = set()
+    latest = since
+    for uuid, last in db.execute(
+            '''select u.uuid, max(p.start_time)
+               from page_stat_data p join uuid u on u.id_book = p.id_book
+               where p.start_time > ?
+               group by u.uuid''', (since,)):
+        if uuid and uuid.startswith(UUID_PREFIX):
+            uuids.add(uuid[len(UUID_PREFIX):])
+            latest = max(latest, last)
+    return uuids, latest
+
+def aggregate(db, uuids, gap=SESSION_GAP):
+    '''
+    Reading (seconds, pages, sessions) of each of the calibre uuids
+    over all their page stats, in one GROUP BY.  Pages counts every
+    page read.  Books without page stats get zeros.
+    '''
+    uuids = list(uuids)
+    totals = dict( (uuid, (0, 0, 0)) for uuid in uuids )
+    if not uuids:
+        return totals
+    for uuid, seconds, pages, sessions in db.execute(
+            '''select u.uuid, sum(p.duration), count(*), sum(p.new_session)
+               from (select id_book, duration,
+                            coalesce(start_time - lag(start_time + duration)
+                                     over (partition by id_book order by start_time),
+                                     :gap + 1) > :gap as new_session
+                     from page_stat_data
+                     where id_book in (select id_book from uuid
+                                       where uuid in (select value from json_each(:uuids)))) p
+               join uuid u on u.id_book = p.id_book
+               group by u.uuid''',
+            {'gap': gap, 'uuids': json.dumps([ UUID_PREFIX + uuid for uuid in uuids ])}):
+        totals[uuid[len(UUID_PREFIX):]] = (seconds or 0, pages, sessions or 0)
+    logger.debug("Statistics of %d books aggregated"%len(uuids))
+    return totals
@@ -0,0 +1,185 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""Merge the statistics of books whose titles only differ by my title decorations."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import re
+import apsw
+
+import logging
+logger = logging.getLogger(__name__)
+
+## titles in my library can be:
+## "The book title"
+## "000 The book title"
+## "000 The book title (123,123)"
+## "The book title (123,123)"
+_PREFIX_RE = re.compile(r"^000 (?=.)")
+_SUFFIX_RE = re.compile(r"^(.+?) \([0-9,]+\).*$", re.S)
+
+## book columns summed into the merged book.
+SUM_COLUMNS = ('notes', 'highlights', 'total_read_time', 'total_read_pages')
+
+def normalize_title(title):
+    '''The title without the "000 " prefix and the word count suffix.'''
+    if not title:
+        return title
+    return _SUFFIX_RE.sub(r"\1", _PREFIX_RE.sub("", title))
+
+def connect(path):
+    '''
+    apsw Connection to a statistics.sqlite3 with normalize_title
+    available in SQL as norm_title().
+    '''
+    db = apsw.Connection(path)
+    add_functions(db)
+    return db
+
+def memory_copy(path):
+    '''
+    An in-memory copy of the database at path, with the stats SQL
+    functions, so changes to it never touch the file.
+    '''
+    source = apsw.Connection(path, flags=apsw.SQLITE_OPEN_READONLY)
+    try:
+        db = apsw.Connection(':memory:')
+        with db.backup('main', source, 'main') as backup:
+            backup.step()
+    finally:
+        source.close()
+    add_functions(db)
+    return db
+
+def add_functions(db):
+    db.createscalarfunction('norm_title', normalize_title, 1)
+
+def has_table(db, name):
+    return bool(db.execute("select 1 from sqlite_master where type='table' and name=?",
+                           (name,)).fetchall())
+
+def plan(db):
+    '''
+    Fill temp table merge with (id, norm, keeper) for every book:
+    books with the same normalized title and authors all go to the
+    most recently opened of them.  Books mapped to different calibre
+    uuids are never merged, in such a group each mapped book keeps
+    its own and the unmapped ones only merge with each other.
+    '''
+    db.execute('drop table if exists temp.merge')
+    ## keyed by id, the updates look up every moved row's book in it.
+    db.execute('create temp table merge (id integer primary key, norm text, keeper integer)')
+    if has_table(db, 'uuid'):
+        books = '''select b.id, norm_title(b.title) as norm, b.authors, b.last_open, u.uuid
+                   from book b left join uuid u on u.id_book = b.id'''
+    else:
+        books = 'select id, norm_title(title) as norm, authors, last_open, null as uuid from book'
+    ## min and max ignore nulls, they differ when the group has more
+    ## than one uuid.
+    db.execute('''insert into merge (id, norm, keeper)
+                  select id, norm,
+                         first_value(id) over (partition by norm, authors, split
+                                               order by last_open desc, id desc)
+                  from (select id, norm, authors, last_open,
+                               case when min(uuid) over title_authors < max(uuid) over title_authors
+                                    then uuid end as split
+                        from (%s)
+                        window title_authors as (partition by norm, authors))'''%books)
+    db.execute('create index temp.merge_keeper on merge (keeper)')
+    db.execute("create temp view if not exists merged as select id, keeper from merge where id != keeper")
+
+def migrate(db):
+    '''
+    Merge the books plan() groups together, in one transaction:
+    their counts are summed into the keeper, their page_stat_data
+    and uuid rows moved to it and then they're deleted.  Keepers get
+    the normalized title.  Once merged every group is a single book,
+    so running it again changes nothing.  Returns counts of what was
+    done.
+    '''
+    counts = {}
+    with db:
+        plan(db)
+        counts['books merged'] = db.execute('select count(*) from merged').fetchall()[0][0]
+        db.execute('update book set %s where id in (select keeper from merged)'%', '.join(
+                '''%s=(select sum(b.%s) from merge m join book b on b.id=m.id
+                       where m.keeper=book.id)'''%(col, col) for col in SUM_COLUMNS))
+
+        ## page stats already on the keeper for the same page and
+        ## start time are left behind, and go with the merged book.
+        before = db.totalchanges()
+        db.execute('''update or ignore page_stat_data
+                      set id_book=(select keeper from merged where merged.id=page_stat_data.id_book)
+                      where id_book in (select id from merged)''')
+        counts['page stats moved'] = db.totalchanges() - before
+        before = db.totalchanges()
+        db.execute('delete from page_stat_data where id_book in (select id from merged)')
+        counts['page stats dropped'] = db.totalchanges() - before
+
+        if has_table(db, 'uuid'):
+            ## plan() never merges two mapped books, so this can't
+            ## collide with the keeper's own uuid row.
+            db.execute('''update uuid
+                          set id_book=(select keeper from merged where merged.id=uuid.id_book)
+                          where id_book in (select id from merged)''')
+
+        db.execute('delete from book where id in (select id from merged)')
+        before = db.totalchanges()
+        db.execute('''update or ignore book
+                      set title=(select norm from merge where merge.id=book.id)
+                      where title is not (select norm from merge where merge.id=book.id)''')
+        counts['titles normalized'] = db.totalchanges() - before
+        db.execute('drop view temp.merged')
+        db.execute('drop table temp.merge')
+    logger.info("statistics migrated: %s"%counts)
+    return counts
+
+def book_times(db):
+    '''
+    {id: (title, total_read_time, seconds in page_stat_data)} of
+    every book.
+    '''
+    seconds = dict(db.execute('select id_book, sum(duration) from page_stat_data group by id_book'))
+    return { id_book: (title, total_read_time, seconds.get(id_book, 0))
+             for id_book, title, total_read_time in db.execute('select id, title, total_read_time from book') }
+
+def dry_run(path):
+    '''
+    Run migrate on an in-memory copy of the statistics.sqlite3 at
+    path, inside a savepoint rolled back after, and report what it
+    would do:
+
+        {"counts": {...},
+         "merged": {keeper id: [merged ids]},
+         "books": {id: {"title": [before, after],
+                        "total_read_time": [before, after],
+                        "page_stat_seconds": [before, after]}}}
+
+    books only has the books that would change, their
+    page_stat_seconds delta is the time their merged books bring.
+    '''
+    db = memory_copy(path)
+    try:
+        db.execute('savepoint dry_run')
+        try:
+            before = book_times(db)
+            plan(db)
+            merged = {}
+            for id_book, keeper in db.execute('select id, keeper from merged order by keeper, id'):
+                merged.setdefault(keeper, []).append(id_book)
+            counts = migrate(db)
+            after = book_times(db)
+        finally:
+            db.execute('rollback to dry_run')
+            db.execute('release dry_run')
+    finally:
+        db.close()
+    books = {}
+    for id_book, new in after.items():
+        old = before[id_book]
+        if old != new:
+            books[id_book] = dict(zip(('title', 'total_read_time', 'page_stat_seconds'),
+                                      ( [a, b] for a, b in zip(old, new) )))
+    return {'counts': counts, 'merged': merged, 'books': books}
@@ -0,0 +1,148 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:fdm=indent:ai
+
+"""Fill the uuid table 2-statistics-with-uuid-key.lua looks books up by."""
+
+__license__ = "GPL v3"
+__copyright__ = "2025, Jim Miller"
+__docformat__ = "markdown en"
+
+import os
+import re
+import json
+import apsw
+
+import logging
+logger = logging.getLogger(__name__)
+
+from .migrate import normalize_title, has_table
+from .digest import partial_md5
+
+UUID_PREFIX = 'calibre:'
+
+UUID_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS uuid
+        (
+            uuid        TEXT PRIMARY KEY,
+            id_book     INTEGER,
+            UNIQUE (id_book),
+            FOREIGN KEY(id_book) REFERENCES book(id)
+        );
+'''
+
+## KOReader has one author per line, calibre joins them with ' & '
+## in places.
+_AUTHORS_SPLIT_RE = re.compile(r'\n| & ')
+
+def title_key(title, authors):
+    '''
+    What a statistics book and a calibre book have to share to be
+    taken as the same book.  authors is a string or a list.
+    '''
+    if isinstance(authors, str):
+        authors = _AUTHORS_SPLIT_RE.split(authors)
+    return ((normalize_title(title or '') or '').strip().casefold(),
+            tuple(sorted( a.strip().casefold() for a in authors or () if a.strip() )))
+
+def library_books(library_db_path):
+    '''
+    (uuid, title, [authors]) of every book in a calibre library's
+    metadata.db, in one query.
+    '''
+    db = apsw.Connection(library_db_path, flags=apsw.SQLITE_OPEN_READONLY)
+    try:
+        rows = db.execute('''select b.uuid, b.title, group_concat(a.name, char(10))
+                             from books b
+                             left join books_authors_link l on l.book = b.id
+                             left join authors a on a.id = l.author
+                             group by b.id''').fetchall()
+    finally:
+        db.close()
+    return [ (uuid, title, (authors or '').split('\n')) for uuid, title, authors in rows ]
+
+def device_books(device_root):
+    '''
+    (uuid, title, [authors], partial md5) of the books in calibre's
+    device book list, metadata.calibre, at device_root.  The digests
+    are of the files on the device, as KOReader computes them.
+    '''
+    with open(os.path.join(device_root, 'metadata.calibre'), encoding='utf-8') as f:
+        books = json.load(f)
+    result = []
+    for book in books:
+        path = os.path.join(device_root, *book['lpath'].split('/'))
+        try:
+            md5 = partial_md5(path)
+        except OSError:
+            md5 = None
+        result.append((book.get('uuid'), book.get('title'), book.get('authors'), md5))
+    return result
+
+class Matcher:
+    '''
+    Hash indexes from md5 and from title_key to calibre uuid.  Keys
+    that more than one calibre book has are left out, they can't be
+    matched.
+    '''
+
+    def __init__(self):
+        self.by_md5 = {}
+        self.by_title = {}
+
+    def _add(self, index, key, uuid):
+        if index.get(key, uuid) != uuid:
+            uuid = None
+        index[key] = uuid
+
+    def add(self, uuid, title, authors, md5=None):
+        if not uuid:
+            return
+        if md5:
+            self._add(self.by_md5, md5, uuid)
+        self._add(self.by_title, title_key(title, authors), uuid)
+
+    def match(self, title, authors, md5):
+        return self.by_md5.get(md5) or self.by_title.get(title_key(title, authors))
+
+def unmapped_books(db):
+    '''
+    (title, authors, md5) of the statistics books without a uuid
+    row, all of them without the uuid table.
+    '''
+    if not has_table(db, 'uuid'):
+        return db.execute('select title, authors, md5 from book').fetchall()
+    return db.execute('''select title, authors, md5 from book
+                         where not exists (select 1 from uuid where uuid.id_book = book.id)''').fetchall()
+
+def mapped_uuids(db):
+    '''Calibre uuids the uuid table already maps.'''
+    if not has_table(db, 'uuid'):
+        return set()
+    return set( uuid[len(UUID_PREFIX):] for (uuid,) in db.execute('select uuid from uuid')
+                if uuid and uuid.startswith(UUID_PREFIX) )
+
+def populate(db, matcher):
+    '''
+    Map every statistics book matcher knows to its calibre uuid, in
+    one transaction, creating the uuid table if needed.  Books
+    already mapped keep their uuid.  A calibre book matching several
+    statistics books goes to the last opened one.  Returns the
+    number of books newly mapped.
+    '''
+    with db:
+        db.execute(UUID_SCHEMA)
+        mapped = set( uuid for (uuid,) in db.execute('select uuid from uuid') )
+        rows = {}
+        for id_book, title, authors, md5 in db.execute(
+                '''select id, title, authors, md5 from book
+                   where not exists (select 1 from uuid where uuid.id_book = book.id)
+                   order by last_open'''):
+            uuid = matcher.match(title, authors, md5)
+            if uuid:
+                uuid = UUID_PREFIX + uuid
+                if uuid not in mapped:
+                    rows[uuid] = id_book
+        db.executemany('''insert into uuid (uuid, id_book) values (?, ?)
+                          on conflict (id_book) do update set uuid=excluded.uuid''',
+                       list(rows.items()))
+    logger.info("%d statistics books mapped to calibre uuids"%len(rows))
+    return len(rows)